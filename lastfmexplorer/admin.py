@@ -10,6 +10,7 @@ admin.site.register(Artist)
 admin.site.register(Album)
 admin.site.register(Track)
 admin.site.register(WeekData)
+admin.site.register(UserWeekTotal)
 admin.site.register(WeekTrackData)
 admin.site.register(Tag)
 admin.site.register(WeeksWithSyntaxErrors)
@@ -0,0 +1,118 @@
+"""
+Helpers shared by the bench_* management commands.
+"""
+import json
+import os
+import resource
+import time
+
+from django.db import connection
+
+
+def best_of(fn, repeat=3, setup=None, teardown=None):
+    """
+    Calls fn repeat times and returns (fastest time in seconds, result of the
+    last call).  setup and teardown are called around each run but aren't
+    timed.
+    """
+    best = None
+    result = None
+    for _ in xrange(repeat):
+        if setup: setup()
+        began = time.time()
+        result = fn()
+        taken = time.time() - began
+        if teardown: teardown()
+        if best is None or taken < best:
+            best = taken
+    return best, result
+
+
+def per_second(count, seconds):
+    return count / seconds if seconds > 0 else float('inf')
+
+
+def print_table(out, headings, rows):
+    """Writes rows to out as plain text columns under headings."""
+    rows = [map(str, row) for row in rows]
+    widths = [max(len(str(h)), *[len(r[i]) for r in rows]) if rows else len(str(h))
+                  for i, h in enumerate(headings)]
+    line = lambda cells: "  ".join(c.ljust(w) for c, w in zip(cells, widths)).rstrip()
+    out.write(line(map(str, headings)) + "\n")
+    out.write(line(["-" * w for w in widths]) + "\n")
+    for row in rows:
+        out.write(line(row) + "\n")
+
+
+def peak_rss_growth(fn, *args):
+    """
+    Runs fn in a child process and returns how far it pushed the child's peak
+    resident set size above where it started, in kilobytes.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn(*args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write, str(after - before))
+        os._exit(0)
+    os.close(write)
+    growth = int(os.read(read, 64) or 0)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return growth
+
+
+def weekdata_queries(user, artist_id, weeks):
+    """
+    (name, sql, params) of the WeekData queries behind the exploration pages,
+    for a user with weeks weeks of history and an artist they played.
+    """
+    from lastfmexplorer.chart import Chart
+    from lastfmexplorer.models import WeekData
+
+    start, end = weeks / 2, weeks - 1
+    objects = WeekData.objects
+    querysets = (
+        ("overview rows", objects.user_weeks_between(user, start, end)
+                              .values_list('week_idx', 'artist', 'plays')),
+        ("record weeks", objects.user_weeks_between(user, start, end).order_by('-plays')[:10]),
+        ("plays of artist", objects.filter(user=user.id, artist=artist_id).order_by('week_idx')
+                                .values_list('week_idx', 'plays')),
+        ("snapshot weeks", objects.filter(user=user.id, week_idx__in=range(end - 4, end + 1))
+                               .order_by('week_idx', 'rank').values_list('week_idx', 'artist', 'plays', 'rank')),
+    )
+    queries = [(name, ) + qs.query.sql_with_params() for name, qs in querysets]
+
+    chart = Chart(user, start, end)
+    queries.append(("chart",) + chart.query())
+    chart.set_exclude_before_start()
+    queries.append(("chart, new only",) + chart.query())
+    return queries
+
+
+def explain(sql, params):
+    """
+    Runs sql under EXPLAIN ANALYZE on PostgreSQL.  Returns (milliseconds,
+    scans used, partitions scanned).
+    """
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    plan = plan[0]
+    milliseconds = plan.get('Execution Time', plan.get('Total Runtime'))
+
+    scans, relations = [], set()
+    def walk(node):
+        if 'Scan' in node['Node Type']:
+            scans.append(node.get('Index Name') or node['Node Type'])
+            if 'Relation Name' in node:
+                relations.add(node['Relation Name'])
+        for child in node.get('Plans', ()):
+            walk(child)
+    walk(plan['Plan'])
+    return milliseconds, ", ".join(sorted(set(scans))), len(relations)
@@ -1,9 +1,14 @@
 import collections
+import heapq
+from operator import itemgetter
+
+import numpy as np
 
 import ldates
+import snapshot
 from models import Artist, WeekData
 
-from django.db.models import Sum
+from django.db import connection
 
 
 class Chart(collections.Sequence):
@@ -41,66 +46,93 @@ class Chart(collections.Sequence):
 
     def _chart(self):
         """
-        Return generator for chart between dates excluding artists as specified.
+        Works out the chart between dates excluding artists as specified.
+        Exclusions, ordering and the limit are all done by the database, so
+        only the rows shown are fetched.
         """
-        # Exclusions
-        excluded = set()
-        if self.only_new:
-            # Note that this will include artists with 0 plays, should they ever end up in WeekData
-            previous = map(lambda a: a['artist'],
-                           WeekData.objects
-                            .user_weeks_between(self.user, ldates.idx_beginning, self.start-1)
-                            .values('artist'))
-            excluded.update(previous)
-            del previous
+        # count comes from the query string; LIMIT won't take a negative.
+        if self.count <= 0:
+            return self._set_chart([])
 
+        totals = snapshot.load_totals(self.user.id)
+        if totals is not None:
+            return self._chart_from_totals(totals)
+        if WeekData.objects.packed():
+            return self._chart_from_packed()
+
+        cursor = connection.cursor()
+        cursor.execute(*self.query())
+        self._set_chart(cursor.fetchall())
+
+    def _set_chart(self, top):
+        """
+        Makes the chart from top, (artist id, total) pairs in descending
+        order, so the first is the chart's maximum.
+        """
+        artists = Artist.objects.in_bulk([artist_id for artist_id, _ in top])
+        self.chart = [(artists[artist_id], int(total)) for artist_id, total in top]
+        self.max = self.chart[0][1] if self.chart else None
+
+    def _excluded_weeks(self):
+        """(first, last) week ranges whose artists are left out of the chart."""
+        excluded = []
+        if self.only_new:
+            excluded.append((ldates.idx_beginning, self.start-1))
         if self.exclude_months and self.months_excluded > 0:
             # artists played in last n months:
-            n_ago = ldates.idx_last_sunday - (self.months_excluded * 4)
-            recent = map(lambda a: a['artist'],
-                         WeekData.objects
-                          .user_weeks_between(self.user, n_ago, ldates.idx_last_sunday) 
-                          .values('artist'))
-            excluded.update(recent)
-            del recent
-
-        # Load artists
-        # every artist listened to between start and end, with playcounts
-        artist_and_playcount = WeekData.objects.user_weeks_between(self.user, self.start, self.end)\
-                 .values('artist')\
-                 .annotate(Sum('plays'))\
-                 .order_by('-plays__sum')
-
-        artist_ids = []
-        to_go = self.count
-
-        # load all artists, transform to id => artist dict
-        for d in artist_and_playcount:
-            artist_id = d['artist']
-            if artist_id not in excluded:
-                artist_ids.append(artist_id)
-                to_go -= 1
-                if to_go <= 0:
-                    break
-        artists = Artist.objects.in_bulk(artist_ids)
-
-        to_go = self.count
-        c = []
-        need_max = True
-        for d in artist_and_playcount:
-            # need the maximum for chart widths.
-            artist_id = d['artist']
-            if artist_id not in excluded:
-                to_go -= 1
-                if to_go < 0:
-                    break
-                if need_max:
-                    self.max = d['plays__sum']
-                    need_max = False
+            last_sunday = ldates.index_of_last_sunday()
+            n_ago = last_sunday - (self.months_excluded * 4)
+            excluded.append((n_ago, last_sunday))
+        return excluded
 
-                c.append((artists[artist_id], d['plays__sum']))
+    def query(self):
+        """
+        Returns (sql, params) for the chart's artist ids and play counts,
+        most played first.
+        """
+        table = connection.ops.quote_name(WeekData._meta.db_table)
+        query = ["SELECT wd.artist_id, SUM(wd.plays) AS total FROM %s wd"
+                 " WHERE wd.user_id = %%s AND wd.week_idx BETWEEN %%s AND %%s" % (table,)]
+        params = [self.user.id, self.start, self.end]
+
+        for first, last in self._excluded_weeks():
+            # The user's id rather than wd.user_id, so partitions are pruned
+            # when the plan is made (see partitioning).
+            query.append("AND NOT EXISTS (SELECT 1 FROM %s ex WHERE ex.user_id = %%s"
+                         " AND ex.artist_id = wd.artist_id AND ex.week_idx BETWEEN %%s AND %%s)" % (table,))
+            params.extend((self.user.id, first, last))
+
+        query.append("GROUP BY wd.artist_id ORDER BY total DESC LIMIT %s")
+        params.append(max(self.count, 0))
+        return " ".join(query), params
+
+    def _chart_from_totals(self, totals):
+        """
+        As _chart, using the per artist running totals stored with the user's
+        snapshot instead of querying WeekData.
+        """
+        plays = totals.between(self.start, self.end)
+
+        keep = np.ones(len(plays), dtype=bool)
+        for first, last in self._excluded_weeks():
+            keep &= totals.between(first, last) == 0
+
+        self._set_chart(totals.top(plays, self.count, keep))
 
-        self.chart = c
+    def _chart_from_packed(self):
+        """
+        As _chart, totalling the user's PackedWeekData in Python, which
+        works the same whether they're stored as arrays or text.
+        """
+        excluded = set()
+        for first, last in self._excluded_weeks():
+            excluded.update(artist_id for _, artist_id, _, _ in WeekData.objects.week_rows(self.user.id, first, last))
+
+        totals = collections.defaultdict(int)
+        for _, artist_id, plays, _ in WeekData.objects.week_rows(self.user.id, self.start, self.end):
+            if artist_id not in excluded:
+                totals[artist_id] += plays
+        self._set_chart(heapq.nlargest(self.count, totals.iteritems(), key=itemgetter(1)))
 
     def __repr__(self):
         entries = 'uncalculated' if not self.chart else len(self.chart)
@@ -5,17 +5,25 @@ Last.fm's charts are effectively release each Sunday noon, and the first charts
 were published February 20th 2005.  This information makes storing dates a lot
 simpler -- rather than storing a full date we can store an index into the list
 where [0] = 20/02/05, [1] = 27/02/05, etc.
+
+What today is comes from a clock, date.today unless set_clock says otherwise,
+so long running processes move on to each new week by themselves.
+
+The functions at the end work on arrays of indices or timestamps at a time,
+and give the same answers as their one-at-a-time counterparts.
 """
 
+import time
 from datetime import date, timedelta, datetime
 
+import numpy as np
+
 the_beginning = date(2005,2,20)
 idx_beginning = 0
 ts_beginning  = 1108252800
 
-today         = date.today()
-
 one_week      = timedelta(days=7)
+seconds_in_week = 604800 # 60 * 60 * 24 * 7
 month_in_weeks= 4
 year_in_weeks = 52
 
@@ -46,7 +54,6 @@ def date_of_string(s, fallback=None):
 
 def timestamp_of_index(idx):
     """Returns a Unix timestamp for the date represented by idx."""
-    seconds_in_week = 604800 # 60 * 60 * 24 * 7
     return ts_beginning + (idx * seconds_in_week)
 
 def js_timestamp_of_index(idx):
@@ -83,10 +90,45 @@ def first_sunday_on_or_before(d):
 fsooa = first_sunday_on_or_after
 fsoob = first_sunday_on_or_before
 
-idx_last_sunday = first_sunday_on_or_before(today)
+# A function returning today's date, see set_clock.
+_clock = date.today
+
+# [first day, day after the last, index] of the week index_of_last_sunday
+# last worked out.
+_this_week = [date.max, date.min, None]
+
+# Stands for the last Sunday in URL defaults, which are made once but used
+# for months.
+LAST_SUNDAY = 'last-sunday'
+
+def set_clock(clock=None):
+    """
+    Makes today() ask clock, a function returning a date, instead of
+    date.today.  Without a clock, date.today is put back.
+    """
+    global _clock
+    _clock = clock or date.today
+    _this_week[:] = [date.max, date.min, None]
+
+def today():
+    return _clock()
+
+def index_of_last_sunday():
+    """
+    The index of the last Sunday on or before today.  Only worked out again
+    once today has left the week it was last worked out for.
+    """
+    d = _clock()
+    first, after, idx = _this_week
+    if not first <= d < after:
+        idx = first_sunday_on_or_before(d)
+        sunday = date_of_index(idx)
+        # Days before the_beginning all count as week 0 too.
+        _this_week[:] = [min(sunday, d), sunday + one_week, idx]
+    return idx
 
 def years_to_today():
-    return xrange(2005, date.today().year + 1)
+    return xrange(2005, today().year + 1)
 
 def indicies_of_year(year):
     return fsooa(date(year, 1, 1)), fsooa(date(year, 12, 31))
@@ -96,10 +138,10 @@ def all_sundays_falling_in(year):
     return xrange(fsooa(date(year, 1, 1)), fsooa(date(year+1, 1, 1)))
 
 def months_ago(num):
-    return idx_last_sunday - (month_in_weeks * num)
+    return index_of_last_sunday() - (month_in_weeks * num)
 
 def years_ago(num):
-    return idx_last_sunday - (year_in_weeks * num)
+    return index_of_last_sunday() - (year_in_weeks * num)
 
 def days_between(a, b):
     """Returns the number of days between days a and b."""
@@ -108,12 +150,77 @@ def days_between(a, b):
 def sensible_to_update(last):
     """Returns True if last update was before today and before 
        the last Sunday, otherwise False."""
-    return last < today and last < date_of_index(idx_last_sunday)
+    return last < today() and last < date_of_index(index_of_last_sunday())
 
 def weeks_to_last_sunday(d):
-    return sundays_between(d, today)
+    return sundays_between(d, today())
 
 def sundays_between(d1, d2):
     start = first_sunday_on_or_after(d1)
     end = first_sunday_on_or_before(d2)
-    return range(start, end+1)
\ No newline at end of file
+    return range(start, end+1)
+
+
+###############################################################################
+########## Arrays of weeks ####################################################
+
+_np_beginning = np.datetime64(the_beginning.isoformat(), 'D')
+def dates_of_indices(idxs):
+    """
+    date_of_index for an array of week indices, as datetime64[D]s.  Their
+    tolist() is a list of datetime.dates.
+    """
+    idxs = np.asarray(idxs, dtype=np.int64)
+    if (idxs < 0).any():
+        raise ValueError("Week indices (given %d) cannot be less than zero" % (idxs.min(),))
+    return _np_beginning + (idxs * 7).astype('m8[D]')
+
+def months_of_indices(idxs):
+    """The month, 1 to 12, of each week index."""
+    return dates_of_indices(idxs).astype('M8[M]').astype(np.int64) % 12 + 1
+
+def years_of_indices(idxs):
+    """The year of each week index."""
+    return dates_of_indices(idxs).astype('M8[Y]').astype(np.int64) + 1970
+
+def year_starts(years):
+    """The index of the first Sunday of each year, as indicies_of_year gives."""
+    jan_1sts = (np.asarray(years, dtype=np.int64) - 1970).astype('M8[Y]').astype('M8[D]')
+    days = (jan_1sts - _np_beginning).astype(np.int64)
+    return np.maximum(-(-days // 7), 0)
+
+def timestamps_of_indices(idxs):
+    """timestamp_of_index for an array of week indices."""
+    return ts_beginning + np.asarray(idxs, dtype=np.int64) * seconds_in_week
+
+# Local midnight of each day from the_beginning, see indices_of_timestamps.
+_midnights = np.zeros(0)
+
+def _midnights_through(ts):
+    global _midnights
+    if not len(_midnights) or _midnights[-1] <= ts:
+        last = max(date.fromtimestamp(ts), today()) + timedelta(days=366)
+        days = (last - the_beginning).days
+        _midnights = np.array([time.mktime((the_beginning + timedelta(days=d)).timetuple())
+                                   for d in xrange(days + 1)])
+    return _midnights
+
+def indices_of_timestamps(timestamps):
+    """
+    index_of_timestamp for an array of Unix timestamps, raising ValueError
+    if any isn't on a Sunday.  Days are found in a table of local midnights
+    made by time.mktime, so they agree with date.fromtimestamp across
+    daylight saving changes.
+    """
+    ts = np.asarray(timestamps, dtype=np.float64)
+    idxs = np.zeros(len(ts), dtype=np.int64)
+    if not len(ts):
+        return idxs
+    days = np.searchsorted(_midnights_through(ts.max()), ts, side='right') - 1
+    before = days < 0
+    if (days[~before] % 7).any():
+        raise ValueError("date passed to index_of_sunday must be a Sunday")
+    idxs[~before] = days[~before] // 7
+    # Rare enough to leave to index_of_timestamp.
+    idxs[before] = [index_of_timestamp(t) for t in ts[before].tolist()]
+    return idxs
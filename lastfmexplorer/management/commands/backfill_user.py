@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lastfmexplorer import tasks
+from lastfmexplorer.requester import LastFMRequester
+
+
+class Command(BaseCommand):
+    args = "<username username ...>"
+    help = "Fetches every missing week of each user's data with many concurrent requests."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=None,
+            help="Concurrent requests, default settings.LASTFM_FETCH_WORKERS"),
+        make_option('--rate', type='float', default=None,
+            help="Requests per second, default settings.LASTFM_REQUESTS_PER_SECOND"),
+        make_option('--queue', action='store_true', default=False,
+            help="Run the backfill in a celery task rather than here"),
+    )
+
+    def handle(self, *usernames, **options):
+        if not usernames:
+            raise CommandError("Give at least one username")
+
+        requester = LastFMRequester()
+        for username in usernames:
+            try:
+                user = tasks.get_or_add_user(username, requester)
+            except tasks.GetUserFailed, e:
+                raise CommandError("Couldn't find %s: %s" % (username, e))
+
+            if tasks.backfill_user(user, requester, options['workers'], options['rate'], options['queue']):
+                self.stdout.write("%s: %s\n" % (username, "queued" if options['queue'] else "done"))
+            else:
+                self.stdout.write("%s: nothing to fetch\n" % (username,))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from lastfmexplorer import usercache
+from lastfmexplorer.models import User, UserWeekTotal
+
+
+class Command(BaseCommand):
+    args = "[username username ...]"
+    help = "Rebuilds UserWeekTotal from WeekData for the given users, or for everyone."
+
+    def handle(self, *usernames, **options):
+        users = User.objects.all()
+        if usernames:
+            users = users.filter(username__in=usernames)
+            missing = set(usernames).difference(u.username for u in users)
+            if missing:
+                raise CommandError("No such users: %s" % (", ".join(sorted(missing)),))
+
+        for user in users:
+            with transaction.commit_on_success():
+                weeks = UserWeekTotal.objects.rebuild(user.id)
+            usercache.bump_version(user.id)
+            self.stdout.write("%s: %d weeks\n" % (user.username, weeks))
@@ -0,0 +1,97 @@
+import random
+from datetime import date
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Sum
+
+from lastfmexplorer import benchmarks, ldates
+from lastfmexplorer.chart import Chart
+from lastfmexplorer.models import Artist, User, WeekData
+
+
+def python_chart(user, start, end, count, excluded_weeks):
+    """
+    How charts were made before the exclusions and limit moved into SQL:
+    load excluded artists into a set and walk every artist played in range.
+    """
+    excluded = set()
+    for first, last in excluded_weeks:
+        excluded.update(WeekData.objects.user_weeks_between(user, first, last)
+                            .values_list('artist', flat=True))
+    totals = WeekData.objects.user_weeks_between(user, start, end) \
+                 .values('artist').annotate(Sum('plays')).order_by('-plays__sum')
+    top = [(d['artist'], d['plays__sum']) for d in totals if d['artist'] not in excluded][:count]
+    artists = Artist.objects.in_bulk([a for a, _ in top])
+    return [(artists[a], plays) for a, plays in top]
+
+
+def sql_chart(user, start, end, count, excluded_weeks):
+    chart = Chart(user, start, end, count)
+    if excluded_weeks:
+        chart.set_exclude_before_start()
+    return list(chart)
+
+
+def in_child(fn, *args):
+    # A forked child mustn't share the parent's database connection.
+    connection.connection = None
+    fn(*args)
+
+
+class Command(BaseCommand):
+    help = "Compares peak memory and time of charts made in Python and in SQL for a user with many artists."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--artists', type='int', default=25000,
+            help="Distinct artists the synthetic user played"),
+        make_option('--weeks', type='int', default=260,
+            help="Weeks of history"),
+        make_option('--per-week', type='int', default=300,
+            help="Artists played each week"),
+        make_option('--repeat', type='int', default=3,
+            help="Runs of each chart, the fastest is reported"),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        num_artists, num_weeks = options['artists'], options['weeks']
+        generator = random.Random(2005)
+
+        try:
+            user = User.objects.create(username="bench-chart", registered=date.today(),
+                                       last_updated=date.today(), image="")
+            artist_ids = Artist.objects.ids_of_names(
+                    "bench-chart-artist-%d" % (i,) for i in xrange(num_artists)).values()
+            # Every artist at least once, then a random selection each week.
+            weeks = dict((w, {}) for w in xrange(num_weeks))
+            for i, artist_id in enumerate(artist_ids):
+                weeks[i % num_weeks][artist_id] = (generator.randint(1, 50), 0)
+            for played in weeks.itervalues():
+                for artist_id in generator.sample(artist_ids, options['per_week']):
+                    played[artist_id] = (generator.randint(1, 50), 0)
+            rows = WeekData.objects.insert_weeks(user.id, weeks)
+            # Committed so forked children, on their own connections, can see it.
+            transaction.commit()
+
+            half = num_weeks / 2
+            scenarios = (("all weeks", 0, num_weeks - 1, ()),
+                         ("second half, new only", half, num_weeks - 1, ((ldates.idx_beginning, half - 1),)))
+            results = []
+            for name, start, end, excluded in scenarios:
+                for method, fn in (("python", python_chart), ("sql", sql_chart)):
+                    args = (user, start, end, 100, excluded)
+                    seconds, _ = benchmarks.best_of(lambda: fn(*args), options['repeat'])
+                    kb = benchmarks.peak_rss_growth(in_child, fn, *args)
+                    results.append((name, method, "%.3f" % (seconds,), kb))
+                transaction.commit()
+        finally:
+            transaction.rollback()
+            WeekData.objects.filter(user__username="bench-chart").delete()
+            User.objects.filter(username="bench-chart").delete()
+            Artist.objects.filter(name__startswith="bench-chart-artist-").delete()
+            transaction.commit()
+
+        self.stdout.write("%d rows, %d artists, %d weeks\n" % (rows, num_artists, num_weeks))
+        benchmarks.print_table(self.stdout, ("chart", "method", "seconds", "peak rss kB"), results)
@@ -0,0 +1,76 @@
+import random
+from optparse import make_option
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+
+from lastfmexplorer import benchmarks
+from lastfmexplorer.snapshot import BlockTotals, Snapshot
+
+
+def synthetic_history(weeks, artists, per_week, seed):
+    """
+    A snapshot of a made up user who played per_week artists a week, picked
+    from a long tailed pool of artists, for weeks weeks.
+    """
+    state = np.random.RandomState(seed)
+    columns = []
+    for week in xrange(weeks):
+        played = np.unique(state.zipf(1.3, per_week * 2) % artists)[:per_week]
+        plays = state.randint(1, 40, len(played))
+        columns.append(np.vstack((np.repeat(week, len(played)), played, plays,
+                                  np.arange(1, len(played) + 1))))
+    return Snapshot(np.hstack(columns).astype(np.int32))
+
+
+class Command(BaseCommand):
+    help = "Times top artist charts over random week ranges from a snapshot and from BlockTotals."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--weeks', type='int', default=520,
+            help="Weeks of history, ten years by default"),
+        make_option('--artists', type='int', default=20000,
+            help="Artists the user could have played"),
+        make_option('--per-week', type='int', default=150,
+            help="Artists played each week"),
+        make_option('--queries', type='int', default=500,
+            help="Random ranges charted"),
+        make_option('--count', type='int', default=100,
+            help="Artists in each chart"),
+    )
+
+    def handle(self, *args, **options):
+        snap = synthetic_history(options['weeks'], options['artists'], options['per_week'], 2005)
+        generator = random.Random(2005)
+        ranges = [sorted((generator.randrange(options['weeks']), generator.randrange(options['weeks'])))
+                      for _ in xrange(options['queries'])]
+        count = options['count']
+
+        def from_rows():
+            for start, end in ranges:
+                rows = snap.between(start, end)
+                artist_ids, inverse = np.unique(rows.artist_id, return_inverse=True)
+                totals = np.bincount(inverse, weights=rows.plays)
+                artist_ids[np.argsort(-totals, kind='mergesort')[:count]]
+
+        blocks = [None]
+        def build():
+            blocks[0] = BlockTotals.of_snapshot(snap)
+
+        def from_blocks():
+            for start, end in ranges:
+                blocks[0].top(blocks[0].between(start, end), count)
+
+        build_seconds, _ = benchmarks.best_of(build)
+        rows_seconds, _ = benchmarks.best_of(from_rows)
+        blocks_seconds, _ = benchmarks.best_of(from_blocks)
+
+        self.stdout.write("%d rows, %d artists, %d blocks of %d weeks (%.1f MB), built in %.3fs\n" % (
+            len(snap), len(blocks[0].artist_ids), len(blocks[0].cumulative) - 1,
+            blocks[0].block_weeks, blocks[0].cumulative.nbytes / 1048576.0, build_seconds))
+        n = len(ranges)
+        benchmarks.print_table(self.stdout, ("method", "charts", "seconds", "ms/chart"), [
+            ("snapshot rows", n, "%.3f" % (rows_seconds,), "%.3f" % (rows_seconds * 1000 / n,)),
+            ("block totals", n, "%.3f" % (blocks_seconds,), "%.3f" % (blocks_seconds * 1000 / n,)),
+        ])
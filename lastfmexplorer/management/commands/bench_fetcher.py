@@ -0,0 +1,53 @@
+from functools import partial
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lastfmexplorer import benchmarks, standin, tasks
+from lastfmexplorer.requester import LastFMRequester
+
+RATE = 10000
+
+
+class Command(BaseCommand):
+    help = "Compares fetching weeks one at a time and concurrently from a slow stand-in for Last.fm."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--weeks', type='int', default=40,
+            help="Weeks fetched per run"),
+        make_option('--latency', type='float', default=0.2,
+            help="Seconds the stand-in waits before each response"),
+        make_option('--workers', default="2,4,8,16",
+            help="Comma separated numbers of threads to try"),
+    )
+
+    def handle(self, *args, **options):
+        server = standin.StandInServer(latency=options['latency']).start()
+        try:
+            # Rates high enough that only latency holds things up, both the
+            # requester's shared token bucket and the fetcher's own limiter.
+            requester = LastFMRequester(server.root, rate=RATE)
+            chart_list = list(tasks.fetch_chart_list('aradnuk', requester))
+            weeks = [chart_list[i % len(chart_list)] for i in xrange(options['weeks'])]
+
+            def sequential():
+                return len([tasks.week_data('aradnuk', requester, s, e) for s, e in weeks])
+
+            def concurrent(workers):
+                fetched = tasks._fetch_concurrently('aradnuk', requester, weeks, 'artist', workers, RATE)
+                return len([fetch() for _, _, fetch in fetched])
+
+            runs = [("sequential", sequential)]
+            for workers in map(int, options['workers'].split(',')):
+                runs.append(("%d threads" % (workers,), partial(concurrent, workers)))
+
+            results = []
+            for name, run in runs:
+                seconds, fetched = benchmarks.best_of(run, repeat=1)
+                results.append((name, fetched, "%.2f" % (seconds,),
+                                "%.1f" % (benchmarks.per_second(fetched, seconds),)))
+        finally:
+            server.stop()
+
+        self.stdout.write("%d weeks, %.2fs latency\n" % (len(weeks), options['latency']))
+        benchmarks.print_table(self.stdout, ("fetcher", "weeks", "seconds", "weeks/s"), results)
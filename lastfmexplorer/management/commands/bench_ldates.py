@@ -0,0 +1,50 @@
+import time
+from datetime import date
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lastfmexplorer import benchmarks, ldates
+
+
+class Command(BaseCommand):
+    help = "Times ldates' week conversions one value at a time and an array at a time."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--weeks', type='int', default=0,
+            help="Week indices converted, every week to today by default"),
+        make_option('--repeat', type='int', default=5,
+            help="Runs of each conversion, the fastest is reported"),
+    )
+
+    def handle(self, *args, **options):
+        weeks = options['weeks'] or ldates.index_of_last_sunday() + 1
+        idxs = range(weeks)
+        timestamps = [time.mktime(ldates.date_of_index(i).timetuple()) + 12 * 60 * 60 for i in idxs]
+        years = range(ldates.the_beginning.year, date.today().year + 1)
+        # Build the table of midnights before timing.
+        ldates.indices_of_timestamps(timestamps[-1:])
+
+        conversions = (
+            ("index -> date", lambda: [ldates.date_of_index(i) for i in idxs],
+                              lambda: ldates.dates_of_indices(idxs).tolist()),
+            ("index -> month", lambda: [ldates.date_of_index(i).month for i in idxs],
+                               lambda: ldates.months_of_indices(idxs)),
+            ("index -> timestamp", lambda: [ldates.timestamp_of_index(i) for i in idxs],
+                                   lambda: ldates.timestamps_of_indices(idxs)),
+            ("timestamp -> index", lambda: [ldates.index_of_timestamp(t) for t in timestamps],
+                                   lambda: ldates.indices_of_timestamps(timestamps)),
+            ("year -> first index", lambda: [ldates.indicies_of_year(y)[0] for y in years],
+                                    lambda: ldates.year_starts(years)),
+        )
+        rows = []
+        for name, scalar, array in conversions:
+            scalar_seconds, expected = benchmarks.best_of(scalar, options['repeat'])
+            array_seconds, result = benchmarks.best_of(array, options['repeat'])
+            if list(expected) != list(result):
+                raise CommandError("%s: array results differ from scalar ones" % (name,))
+            rows.append((name, "%.2f" % (scalar_seconds * 1000,), "%.2f" % (array_seconds * 1000,),
+                         "%.1fx" % (scalar_seconds / max(array_seconds, 1e-9),)))
+
+        self.stdout.write("%d weeks, %d years\n" % (weeks, len(years)))
+        benchmarks.print_table(self.stdout, ("conversion", "scalar ms", "array ms", "speedup"), rows)
@@ -0,0 +1,69 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from lastfmexplorer import benchmarks, ldates, usercache
+from lastfmexplorer.chart import Chart
+from lastfmexplorer.models import User, WeekData
+from lastfmexplorer.summary import OverviewSummary
+
+
+class Command(BaseCommand):
+    args = "<username>"
+    help = "Compares building a user's overview from the manager methods and from OverviewSummary."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--start', type='int', default=ldates.idx_beginning,
+            help="First week index"),
+        make_option('--end', type='int',
+            help="Last week index, the last Sunday by default"),
+        make_option('--repeat', type='int', default=3,
+            help="Runs of each method, the fastest is reported"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: bench_overview " + self.args)
+        try:
+            user = User.objects.get(username=args[0])
+        except User.DoesNotExist:
+            raise CommandError("No such user: " + args[0])
+        start = options['start']
+        end = ldates.index_of_last_sunday() if options['end'] is None else options['end']
+
+        def managers():
+            objects = WeekData.objects
+            objects.total_plays_between(user, start, end)
+            list(objects.weekly_play_counts(user, start, end))
+            objects.monthly_counts_js(user, start, end)
+            list(objects.record_weeks(user, start, end))
+            list(objects.record_week_totals(user, start, end))
+            list(objects.record_unique_artists_in_week(user, start, end))
+            list(Chart(user, start, end))
+            objects.weekly_play_counts_histogram(user, start, end)
+
+        def summary():
+            overview = OverviewSummary(user, start, end)
+            overview.chart
+            return overview
+
+        def forget_weekly_totals():
+            # Both would otherwise take the weekly totals from the cache after the first run.
+            usercache.bump_version(user.id)
+
+        connection.use_debug_cursor = True
+        results = []
+        try:
+            for name, run in (("managers", managers), ("summary", summary)):
+                del connection.queries[:]
+                seconds, result = benchmarks.best_of(run, options['repeat'], setup=forget_weekly_totals)
+                queries = len(connection.queries) / options['repeat']
+                results.append((name, queries, "%.3f" % (seconds,)))
+        finally:
+            connection.use_debug_cursor = None
+
+        self.stdout.write("%s, weeks %d to %d\n" % (user.username, start, end))
+        benchmarks.print_table(self.stdout, ("method", "queries", "seconds"), results)
+        timings = ", ".join("%s %.3fs" % item for item in sorted(result.timings.items()))
+        self.stdout.write("summary breakdown: %s\n" % (timings,))
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from lastfmexplorer import benchmarks
+from lastfmexplorer.chart import Chart
+from lastfmexplorer.models import PackedWeekData, User, WeekData
+from lastfmexplorer.summary import OverviewSummary
+
+
+def relation_size(table):
+    cursor = connection.cursor()
+    cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+    return cursor.fetchone()[0]
+
+
+class Command(BaseCommand):
+    args = "[username username ...]"
+    help = ("Packs the given users', or the synthetic users of bench_query_plans', WeekData and "
+            "compares on-disk size and read times of rows and packed storage.  "
+            "Everything is rolled back afterwards.")
+
+    def handle(self, *usernames, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Table sizes are only read from PostgreSQL")
+        users = User.objects.filter(username__in=usernames) if usernames else \
+                User.objects.filter(username__startswith="bench-plans-")
+        users = list(users.order_by('id'))
+        if not users:
+            raise CommandError("No users to pack, run bench_query_plans to load synthetic data")
+
+        with transaction.commit_manually():
+            try:
+                rows = sum(PackedWeekData.objects.pack(user.id) for user in users)
+                cursor = connection.cursor()
+                for model in (WeekData, PackedWeekData):
+                    cursor.execute("ANALYZE %s" % (model._meta.db_table,))
+                sizes = dict((storage, relation_size(model._meta.db_table)) for storage, model in
+                                 ((WeekData.objects.STORE_ROWS, WeekData),
+                                  (WeekData.objects.STORE_PACKED, PackedWeekData)))
+
+                user = users[0]
+                last = WeekData.objects.filter(user=user).order_by('-week_idx').values_list('week_idx', flat=True)[0]
+                start = last / 2
+                timings = {}
+                for storage in sizes:
+                    with override_settings(WEEK_DATA_STORAGE=storage, LASTFM_SNAPSHOT_DIR=None):
+                        timings[storage] = [
+                            benchmarks.best_of(lambda: WeekData.objects.week_rows(user.id, 0, last))[0],
+                            benchmarks.best_of(lambda: len(Chart(user, start, last)))[0],
+                            benchmarks.best_of(lambda: OverviewSummary(user, start, last).chart)[0],
+                        ]
+            finally:
+                transaction.rollback()
+
+        self.stdout.write("%d rows of %d users, timings for %s over %d weeks\n" % (
+            rows, len(users), user.username, last + 1))
+        benchmarks.print_table(self.stdout,
+            ("storage", "MB on disk", "bytes/row", "read all s", "chart s", "overview s"),
+            [(storage, "%.1f" % (sizes[storage] / 1048576.0,), sizes[storage] / max(rows, 1))
+                 + tuple("%.3f" % (t,) for t in timings[storage])
+             for storage in (WeekData.objects.STORE_ROWS, WeekData.objects.STORE_PACKED)])
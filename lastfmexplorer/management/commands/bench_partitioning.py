@@ -0,0 +1,74 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from lastfmexplorer import benchmarks, partitioning
+from lastfmexplorer.models import User, WeekData
+
+SOURCE = WeekData._meta.db_table
+LAYOUTS = (("plain", None), ("by user", partitioning.BY_USER), ("by year", partitioning.BY_YEAR))
+
+
+class Command(BaseCommand):
+    args = "[username]"
+    help = ("Copies WeekData into plain, user hash partitioned and year partitioned tables "
+            "and reports EXPLAIN ANALYZE of the exploration pages' queries against each.  "
+            "Everything is rolled back afterwards.  bench_query_plans loads synthetic data to use.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--partitions', type='int', default=16,
+            help="Hash partitions for the user layout"),
+        make_option('--repeat', type='int', default=5,
+            help="Runs of each query, the fastest is reported"),
+    )
+
+    def copy(self, cursor, table, by, partitions):
+        if by:
+            partitioning.create_partitioned(cursor, table, SOURCE, by, partitions)
+        else:
+            cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (table, SOURCE))
+        cursor.execute("INSERT INTO %s SELECT * FROM %s" % (table, SOURCE))
+        partitioning.add_constraints(cursor, table, 'artist_id', None, True, by, foreign_keys=False)
+        cursor.execute("ANALYZE %s" % (table,))
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Partitioning is only supported on PostgreSQL")
+
+        users = User.objects.filter(username=args[0]) if args else \
+                User.objects.filter(username__startswith="bench-plans-").order_by('id')
+        if not users.exists():
+            raise CommandError("No user to explain for, run bench_query_plans to load synthetic data")
+        user = users[0]
+        rows = WeekData.objects.filter(user=user)
+        weeks = rows.values_list('week_idx', flat=True).order_by('-week_idx')[0] + 1
+        artist_id = rows.values_list('artist', flat=True)[0]
+        queries = benchmarks.weekdata_queries(user, artist_id, weeks)
+        quoted = connection.ops.quote_name(SOURCE)
+
+        results = [[name] for name, _, _ in queries]
+        # DDL is transactional in PostgreSQL, so the copies go on rollback.
+        with transaction.commit_manually():
+            try:
+                cursor = connection.cursor()
+                try:
+                    partitioning.check_server(cursor)
+                except ValueError, e:
+                    raise CommandError(str(e))
+                for layout, by in LAYOUTS:
+                    table = "bench_weekdata_%s" % (by or "plain",)
+                    self.copy(cursor, table, by, options['partitions'])
+                    for result, (_, sql, params) in zip(results, queries):
+                        sql = sql.replace(quoted, connection.ops.quote_name(table))
+                        ms, _, scanned = min(benchmarks.explain(sql, params) for _ in xrange(options['repeat']))
+                        result.extend(("%.2f" % (ms,), scanned))
+            finally:
+                transaction.rollback()
+
+        self.stdout.write("%d rows, explaining for %s over %d weeks\n" % (
+            WeekData.objects.count(), user.username, weeks))
+        headings = ["query"]
+        for layout, _ in LAYOUTS:
+            headings.extend((layout + " ms", "tables"))
+        benchmarks.print_table(self.stdout, headings, results)
@@ -0,0 +1,71 @@
+import time
+from datetime import date
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from lastfmexplorer import benchmarks, ldates, tasks
+from lastfmexplorer.models import Update, User
+from lastfmexplorer.utils import WeekSet
+
+
+def chart_list(weeks):
+    """(from, to) timestamps like Last.fm's, ending at noon on each Sunday."""
+    ends = [int(time.mktime(ldates.date_of_index(idx).timetuple())) + 12 * 60 * 60 for idx in xrange(weeks)]
+    return zip([e - 7 * 24 * 60 * 60 for e in ends], ends)
+
+
+def plan_from_updates(user, charts):
+    """How updates were planned before: every COMPLETE Update, then every chart."""
+    successful_requests = Update.objects.weeks_fetched(user)
+    return [(start, end) for start, end in charts
+                if ldates.index_of_timestamp(end) >= user.first_sunday_with_data
+                and (ldates.index_of_timestamp(end), Update.ARTIST) not in successful_requests]
+
+
+class Command(BaseCommand):
+    help = "Compares planning an update from Update rows and from the user's fetched weeks."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--weeks', type='int', default=1000,
+            help="Weeks of history, all but the last few already fetched"),
+        make_option('--errored', type='int', default=10,
+            help="Weeks in the history that errored"),
+        make_option('--repeat', type='int', default=5,
+            help="Runs of each planner, the fastest is reported"),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        num_weeks = options['weeks']
+        charts = chart_list(num_weeks)
+        new_weeks = 2
+        errored = set(xrange(3, num_weeks, max(num_weeks / max(options['errored'], 1), 1))[:options['errored']])
+        fetched = [idx for idx in xrange(num_weeks - new_weeks) if idx not in errored]
+
+        try:
+            user = User.objects.create(username="bench-plan", registered=ldates.the_beginning,
+                                       last_updated=date.today(), image="",
+                                       weeks_fetched=WeekSet.of(fetched))
+            Update.objects.bulk_create(
+                [Update(user=user, week_idx=idx, type=Update.ARTIST, status=Update.COMPLETE) for idx in fetched] +
+                [Update(user=user, week_idx=idx, type=Update.ARTIST, status=Update.ERRORED) for idx in errored])
+            transaction.commit()
+
+            results = []
+            connection.use_debug_cursor = True
+            for name, plan in (("update rows", plan_from_updates), ("fetched weeks", tasks._weeks_to_plan)):
+                del connection.queries[:]
+                seconds, planned = benchmarks.best_of(lambda: plan(user, charts), options['repeat'])
+                queries = len(connection.queries) / options['repeat']
+                results.append((name, len(planned), queries, "%.2f" % (seconds * 1000,)))
+        finally:
+            connection.use_debug_cursor = None
+            transaction.rollback()
+            Update.objects.filter(user__username="bench-plan").delete()
+            User.objects.filter(username="bench-plan").delete()
+            transaction.commit()
+
+        self.stdout.write("%d weeks of history, %d errored, %d new\n" % (num_weeks, len(errored), new_weeks))
+        benchmarks.print_table(self.stdout, ("planner", "weeks planned", "queries", "ms"), results)
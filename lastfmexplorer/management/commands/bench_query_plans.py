@@ -0,0 +1,99 @@
+import random
+from datetime import date
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from lastfmexplorer import benchmarks, ldates
+from lastfmexplorer.models import Artist, User, WeekData
+
+# Made by migration 0009, and dropped for --compare.
+INDEXES = ('weekdata_user_week_plays', 'weekdata_user_artist_week')
+
+PREFIX = "bench-plans-"
+
+
+class Command(BaseCommand):
+    help = ("Loads synthetic WeekData into PostgreSQL, if it isn't there already, "
+            "and reports EXPLAIN ANALYZE of each manager query.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=40,
+            help="Synthetic users"),
+        make_option('--weeks', type='int', default=520,
+            help="Weeks of history per user"),
+        make_option('--per-week', type='int', default=100,
+            help="Artists played by each user each week"),
+        make_option('--artists', type='int', default=50000,
+            help="Artists to choose from"),
+        make_option('--repeat', type='int', default=5,
+            help="Runs of each query, the fastest is reported"),
+        make_option('--compare', action='store_true', default=False,
+            help="Also explain each query with the covering indexes dropped"),
+        make_option('--drop', action='store_true', default=False,
+            help="Delete the synthetic data afterwards"),
+    )
+
+    def load(self, options):
+        generator = random.Random(2005)
+        artist_ids = Artist.objects.ids_of_names(
+                "%sartist-%d" % (PREFIX, i) for i in xrange(options['artists'])).values()
+        for n in xrange(options['users']):
+            with transaction.commit_on_success():
+                user = User.objects.create(username="%s%d" % (PREFIX, n), registered=ldates.the_beginning,
+                                           last_updated=date.today(), image="")
+                weeks = {}
+                for week in xrange(options['weeks']):
+                    played = generator.sample(artist_ids, options['per_week'])
+                    weeks[week] = dict((a, (generator.randint(1, 60), rank)) for rank, a in enumerate(played, 1))
+                rows = WeekData.objects.insert_weeks(user.id, weeks, WeekData.objects.INSERT_COPY)
+            self.stdout.write("loaded %s: %d rows\n" % (user.username, rows))
+        connection.cursor().execute("ANALYZE lastfmexplorer_weekdata")
+        transaction.commit_unless_managed()
+
+    def explain_all(self, queries, repeat):
+        return [min(benchmarks.explain(sql, params) for _ in xrange(repeat)) for _, sql, params in queries]
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("EXPLAIN ANALYZE output is only understood from PostgreSQL")
+
+        users = User.objects.filter(username__startswith=PREFIX)
+        if not users.exists():
+            self.load(options)
+        user = users.order_by('id')[0]
+        weeks = WeekData.objects.filter(user=user).values_list('week_idx', flat=True).order_by('-week_idx')[0] + 1
+        artist_id = WeekData.objects.filter(user=user).values_list('artist', flat=True)[0]
+        total = WeekData.objects.filter(user__username__startswith=PREFIX).count()
+
+        queries = benchmarks.weekdata_queries(user, artist_id, weeks)
+        indexed = self.explain_all(queries, options['repeat'])
+        headings = ["query", "ms", "scans"]
+        rows = [[name, "%.2f" % (ms,), scans] for (name, _, _), (ms, scans, _) in zip(queries, indexed)]
+
+        if options['compare']:
+            # DDL is transactional in PostgreSQL, so the indexes come back on rollback.
+            with transaction.commit_manually():
+                try:
+                    cursor = connection.cursor()
+                    for name in INDEXES:
+                        cursor.execute("DROP INDEX IF EXISTS %s" % (name,))
+                    without = self.explain_all(queries, options['repeat'])
+                finally:
+                    transaction.rollback()
+            headings[2:2] = ["ms without"]
+            for row, (ms, _, _) in zip(rows, without):
+                row[2:2] = ["%.2f" % (ms,)]
+
+        self.stdout.write("%d synthetic rows, explaining for %s over %d weeks\n" % (total, user.username, weeks))
+        benchmarks.print_table(self.stdout, headings, rows)
+
+        if options['drop']:
+            with transaction.commit_on_success():
+                # Straight to SQL: the ORM would load every row before deleting it.
+                connection.cursor().execute(
+                    "DELETE FROM lastfmexplorer_weekdata WHERE user_id IN"
+                    " (SELECT id FROM lastfmexplorer_user WHERE username LIKE %s)", [PREFIX + "%"])
+                User.objects.filter(username__startswith=PREFIX).delete()
+                Artist.objects.filter(name__startswith=PREFIX + "artist-").delete()
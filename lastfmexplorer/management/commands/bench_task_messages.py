@@ -0,0 +1,66 @@
+import cPickle as pickle
+import uuid
+
+from datetime import date
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lastfmexplorer import benchmarks, ldates, tasks
+from lastfmexplorer.models import Update, User
+from lastfmexplorer.requester import LastFMRequester
+
+
+def message(subtask):
+    """Roughly the body celery pickles onto the broker for a subtask."""
+    return pickle.dumps({ 'task' : subtask['task'],
+                          'id' : str(uuid.uuid4()),
+                          'args' : subtask['args'],
+                          'kwargs' : subtask['kwargs'],
+                          'retries' : 0,
+                          'eta' : None,
+                          'expires' : None }, pickle.HIGHEST_PROTOCOL)
+
+
+class Command(BaseCommand):
+    help = "Compares the size and enqueue time of task messages for a long backfill."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--weeks', type='int', default=1000,
+            help="Weeks in the backfill"),
+        make_option('--repeat', type='int', default=5,
+            help="Runs per layout, the fastest is reported"),
+    )
+
+    def handle(self, *args, **options):
+        # Never saved, only pickled.
+        user = User(id=1234, username="bench-messages", registered=ldates.the_beginning,
+                    last_updated=date.today(), image="http://www.example.com")
+        requester = LastFMRequester()
+        weeks = [(ldates.timestamp_of_index(i), ldates.timestamp_of_index(i + 1))
+                    for i in xrange(options['weeks'])]
+        chunk = getattr(settings, 'LASTFM_WEEKS_PER_TASK', 10)
+
+        layouts = (
+            ("objects per week",
+                lambda: [tasks.fetch_week_data.subtask((user, requester, s, e, Update.ARTIST))
+                            for s, e in weeks]),
+            ("ids per week",
+                lambda: [tasks.fetch_week_data.subtask((user.id, user.username, requester.key, s, e, Update.ARTIST))
+                            for s, e in weeks]),
+            ("ids per %d weeks" % (chunk,),
+                lambda: [tasks.fetch_weeks_data.subtask((user.id, user.username, requester.key, weeks[i:i+chunk], Update.ARTIST))
+                            for i in xrange(0, len(weeks), chunk)]),
+        )
+
+        results = []
+        for name, build in layouts:
+            seconds, messages = benchmarks.best_of(lambda: [message(st) for st in build()],
+                                                   repeat=options['repeat'])
+            size = sum(len(m) for m in messages)
+            results.append((name, len(messages), size, size / len(messages), "%.4f" % (seconds,)))
+
+        self.stdout.write("Backfill of %d weeks\n" % (len(weeks),))
+        benchmarks.print_table(self.stdout,
+                ("layout", "messages", "bytes", "bytes/message", "enqueue seconds"), results)
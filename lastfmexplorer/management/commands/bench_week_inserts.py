@@ -0,0 +1,59 @@
+from datetime import date
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from lastfmexplorer import benchmarks
+from lastfmexplorer.models import Artist, User, WeekData
+
+
+class Command(BaseCommand):
+    help = "Compares rows per second written by each WeekData insert strategy."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--weeks', type='int', default=52,
+            help="Weeks written per run"),
+        make_option('--artists', type='int', default=500,
+            help="Artists per week"),
+        make_option('--repeat', type='int', default=3,
+            help="Runs per strategy, the fastest is reported"),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        num_weeks = options['weeks']
+        num_artists = options['artists']
+
+        try:
+            user = User.objects.create(username="bench-inserts", registered=date.today(),
+                                       last_updated=date.today(), image="")
+            artist_ids = Artist.objects.ids_of_names(
+                    "bench-artist-%d" % (i,) for i in xrange(num_artists)).values()
+            transaction.commit()
+
+            weeks = dict((week_idx, dict((aid, (rank, rank)) for rank, aid in enumerate(artist_ids, 1)))
+                            for week_idx in xrange(num_weeks))
+            total = num_weeks * num_artists
+
+            strategies = [WeekData.objects.INSERT_ROWS, WeekData.objects.INSERT_BULK]
+            if connection.vendor == 'postgresql':
+                strategies.append(WeekData.objects.INSERT_COPY)
+            else:
+                self.stdout.write("Not on PostgreSQL, skipping COPY.\n")
+
+            results = []
+            for strategy in strategies:
+                seconds, _ = benchmarks.best_of(
+                        lambda: WeekData.objects.insert_weeks(user.id, weeks, strategy),
+                        repeat=options['repeat'],
+                        teardown=transaction.rollback)
+                results.append((strategy, total, "%.3f" % (seconds,),
+                                "%.0f" % (benchmarks.per_second(total, seconds),)))
+
+            benchmarks.print_table(self.stdout, ("strategy", "rows", "seconds", "rows/s"), results)
+        finally:
+            transaction.rollback()
+            Artist.objects.filter(name__startswith="bench-artist-").delete()
+            User.objects.filter(username="bench-inserts").delete()
+            transaction.commit()
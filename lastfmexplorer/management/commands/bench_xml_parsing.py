@@ -0,0 +1,67 @@
+import glob
+import os
+import re
+
+from optparse import make_option
+
+import lxml.etree as ET
+
+from django.core.management.base import BaseCommand
+
+from lastfmexplorer import benchmarks, tasks
+
+_TEST_DATA = os.path.join(os.path.dirname(tasks.__file__), 'test-data')
+_ARTIST = re.compile(r'<artist rank=.*?</artist>', re.DOTALL)
+_CHILDREN = ('name', 'playcount')
+
+
+def parse_tree(xml):
+    """How weekly charts were parsed before streaming: build the tree, then walk it."""
+    et = ET.fromstring(xml, ET.XMLParser(encoding="utf-8", recover=True))
+    return [tuple(d.find(c).text for c in _CHILDREN) + (d.attrib['rank'],)
+                for d in et.getiterator('artist')]
+
+def parse_stream(xml):
+    return list(tasks._iter_chart_rows(xml, 'artist', _CHILDREN))
+
+_PARSERS = (('tree', parse_tree), ('stream', parse_stream))
+
+
+class Command(BaseCommand):
+    help = "Compares tree and streaming parsing of the weekly artist charts in test-data."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=20,
+            help="Parses per file, the fastest is reported"),
+        make_option('--scale', type='int', default=200,
+            help="Copies of every test artist in the synthetic chart used to measure memory"),
+    )
+
+    def handle(self, *args, **options):
+        files = sorted(glob.glob(os.path.join(_TEST_DATA, 'user.getweeklyartistchart', '*', '*.xml')))
+        charts = [open(f).read() for f in files]
+        size = sum(len(xml) for xml in charts)
+
+        # Throughput over the real, small, charts.
+        results = []
+        for name, parse in _PARSERS:
+            seconds, rows = benchmarks.best_of(lambda: sum(len(parse(xml)) for xml in charts),
+                                               repeat=options['repeat'])
+            results.append((name, rows, "%.4f" % (seconds,),
+                            "%.0f" % (benchmarks.per_second(rows, seconds),),
+                            "%.2f" % (benchmarks.per_second(size, seconds) / 2**20,)))
+        self.stdout.write("%d charts from %s\n" % (len(charts), _TEST_DATA))
+        benchmarks.print_table(self.stdout, ("parser", "rows", "seconds", "rows/s", "MB/s"), results)
+
+        # Memory and throughput over one huge chart made of the real ones.
+        entries = [e for xml in charts for e in _ARTIST.findall(xml)] * options['scale']
+        big = '<?xml version="1.0" encoding="utf-8"?>\n<lfm status="ok"><weeklyartistchart>\n%s\n</weeklyartistchart></lfm>' \
+                    % ('\n'.join(entries),)
+        results = []
+        for name, parse in _PARSERS:
+            seconds, rows = benchmarks.best_of(lambda: len(parse(big)), repeat=3)
+            results.append((name, rows, "%.3f" % (seconds,),
+                            "%.0f" % (benchmarks.per_second(rows, seconds),),
+                            benchmarks.peak_rss_growth(parse, big)))
+        self.stdout.write("\nSynthetic chart of %d artists, %.1f MB\n" % (len(entries), len(big) / float(2**20)))
+        benchmarks.print_table(self.stdout, ("parser", "rows", "seconds", "rows/s", "peak RSS growth (KB)"), results)
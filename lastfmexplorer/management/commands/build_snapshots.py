@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from lastfmexplorer import snapshot
+from lastfmexplorer.models import User
+
+
+class Command(BaseCommand):
+    args = "[username username ...]"
+    help = "Writes snapshots of WeekData for the given users, or for everyone."
+
+    def handle(self, *usernames, **options):
+        if not snapshot.enabled():
+            raise CommandError("Set LASTFM_SNAPSHOT_DIR to use snapshots")
+
+        users = User.objects.all()
+        if usernames:
+            users = users.filter(username__in=usernames)
+            missing = set(usernames).difference(u.username for u in users)
+            if missing:
+                raise CommandError("No such users: %s" % (", ".join(sorted(missing)),))
+
+        for user in users:
+            rows = snapshot.build(user.id)
+            self.stdout.write("%s: %d rows\n" % (user.username, rows))
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from lastfmexplorer.models import PackedWeekData, User, WeekData
+
+
+class Command(BaseCommand):
+    args = "[username username ...]"
+    help = ("Copies the given users', or everyone's, WeekData rows into PackedWeekData, "
+            "ready for WEEK_DATA_STORAGE = 'packed'.  --unpack copies them back.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--unpack', action='store_true', default=False,
+            help="Copy PackedWeekData back to WeekData, to go back to WEEK_DATA_STORAGE = 'rows'"),
+        make_option('--delete', action='store_true', default=False,
+            help="Delete what was copied from once it's copied"),
+    )
+
+    def handle(self, *usernames, **options):
+        users = User.objects.all()
+        if usernames:
+            users = users.filter(username__in=usernames)
+            missing = set(usernames).difference(u.username for u in users)
+            if missing:
+                raise CommandError("No such users: %s" % (", ".join(sorted(missing)),))
+
+        for user in users:
+            with transaction.commit_on_success():
+                if options['unpack']:
+                    rows = PackedWeekData.objects.unpack(user.id)
+                    source = PackedWeekData.objects.filter(user=user.id)
+                else:
+                    rows = PackedWeekData.objects.pack(user.id)
+                    source = WeekData.objects.filter(user=user.id)
+                if options['delete']:
+                    source.delete()
+            self.stdout.write("%s: %d rows\n" % (user.username, rows))
@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from lastfmexplorer import partitioning
+
+
+class Command(BaseCommand):
+    help = ("Converts the week data tables to the partitioned layout in WEEKDATA_PARTITIONING, "
+            "or back to plain tables.  Needs PostgreSQL 11 or later.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--by', choices=partitioning.LAYOUTS,
+            help="Partition by user id hash or by year of week_idx, instead of WEEKDATA_PARTITIONING"),
+        make_option('--partitions', type='int',
+            help="Hash partitions when partitioning by user, instead of WEEKDATA_PARTITIONS"),
+        make_option('--undo', action='store_true', default=False,
+            help="Convert partitioned tables back to plain ones"),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Partitioning is only supported on PostgreSQL")
+        by = options['by'] or partitioning.layout()
+        if not by and not options['undo']:
+            raise CommandError("Give --by or set WEEKDATA_PARTITIONING")
+
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            try:
+                partitioning.check_server(cursor)
+            except ValueError, e:
+                raise CommandError(str(e))
+            for table in sorted(partitioning.TABLES):
+                if options['undo']:
+                    changed = partitioning.unpartition(cursor, table)
+                else:
+                    changed = partitioning.partition(cursor, table, by, options['partitions'])
+                self.stdout.write("%s: %s\n" % (table, "converted" if changed else "unchanged"))
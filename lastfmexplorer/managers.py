@@ -1,17 +1,117 @@
 """
 Managers for some of the classes in models.py.
 """
+import heapq
 import logging
+import StringIO
 
 from datetime import datetime, timedelta
 from operator import itemgetter
 
+import caching.base
+import numpy as np
+
 import ldates
 import models as m
+import snapshot
+import usercache
 
-from django.db import connection, models
+from django.conf import settings
+from django.db import connection, models, transaction, IntegrityError
 from django.db.models import Sum, Count, Min
-from django.core.cache import cache
+
+
+class ArtistManager(caching.base.CachingManager):
+
+    def ids_of_names(self, names, id_cache=None):
+        """
+        Returns a dictionary of artist name to id for every name given,
+        creating artists that don't exist yet.  Names are truncated to
+        MAX_ARTIST_NAME_LENGTH first, so the keys of the result are the
+        truncated names.
+
+        id_cache, if given, is a utils.LRUCache of name to id consulted
+        before the database and filled with whatever the database returns.
+        """
+        names = set(name[:m.MAX_ARTIST_NAME_LENGTH] for name in names)
+        ids = id_cache.get_many(names) if id_cache is not None else {}
+
+        uncached = names.difference(ids)
+        if uncached:
+            ids.update(self.filter(name__in=uncached).values_list('name', 'id'))
+
+        missing = names.difference(ids)
+        if missing:
+            try:
+                with transaction.commit_on_success():
+                    self.bulk_create([m.Artist(name=name) for name in missing])
+            except IntegrityError:
+                # Another worker created some of the missing artists first.
+                # Theirs are as good as ours.
+                logging.info("Lost race creating %d artists, refetching" % (len(missing),))
+                ids.update(self.filter(name__in=missing).values_list('name', 'id'))
+                # The failed insert created none of ours, so the rest are
+                # made one at a time, each safe against the same race.
+                for name in names.difference(ids):
+                    ids[name] = self.get_or_create(name=name)[0].id
+            else:
+                ids.update(self.filter(name__in=missing).values_list('name', 'id'))
+
+        if id_cache is not None and uncached:
+            id_cache.set_many(dict((name, ids[name]) for name in uncached))
+
+        return ids
+
+
+class TrackManager(models.Manager):
+
+    def ids_of_tracks(self, tracks):
+        """
+        Returns a dictionary of (artist id, title) to track id for every
+        (artist id, title) pair given, creating tracks that don't exist yet.
+        Titles are truncated to the maximum title length first.
+        """
+        max_length = self.model._meta.get_field('title').max_length
+        tracks = set((artist_id, title[:max_length]) for artist_id, title in tracks)
+
+        def existing(wanted):
+            artist_ids = set(artist_id for artist_id, _ in wanted)
+            titles = set(title for _, title in wanted)
+            qs = self.filter(artist__in=artist_ids, title__in=titles) \
+                     .values_list('artist', 'title', 'id')
+            return dict(((a, t), i) for a, t, i in qs if (a, t) in wanted)
+
+        ids = existing(tracks)
+        missing = tracks.difference(ids)
+        if missing:
+            try:
+                with transaction.commit_on_success():
+                    self.bulk_create([m.Track(artist_id=a, title=t) for a, t in missing])
+            except IntegrityError:
+                logging.info("Lost race creating %d tracks, refetching" % (len(missing),))
+                ids.update(existing(missing))
+                for artist_id, title in tracks.difference(ids):
+                    ids[(artist_id, title)] = self.get_or_create(artist_id=artist_id, title=title)[0].id
+            else:
+                ids.update(existing(missing))
+
+        return ids
+
+
+class UserManager(caching.base.CachingManager):
+
+    def record_saved_weeks(self, user_id, saved, populated):
+        """
+        Notes on the user that the artist charts of weeks saved have been
+        stored, of which those in populated have any data.
+        """
+        with transaction.commit_on_success():
+            user = self.no_cache().select_for_update().get(id=user_id)
+            user.weeks_fetched.update(saved)
+            user.weeks_with_data.discard(saved)
+            user.weeks_with_data.update(populated)
+            # Saving, rather than update(), lets cache-machine invalidate the user.
+            user.save(update_fields=['weeks_fetched', 'weeks_with_data'])
 
 
 class UpdateManager(models.Manager):
@@ -20,10 +120,17 @@ class UpdateManager(models.Manager):
 
     def weeks_fetched(self, user):
         """Returns a set of (week index, update type) tuples"""
-        successes = set()
-        for success in self.filter(user=user, status=m.Update.COMPLETE):
-            successes.add((success.week_idx, success.type))
-        return successes
+        return set(self.filter(user=user, status=m.Update.COMPLETE).values_list('week_idx', 'type'))
+
+    def finish(self, user, type, complete, errored):
+        """
+        Marks in-progress updates of type for the given sets of week indexes
+        as COMPLETE or ERRORED, with one statement for each.
+        """
+        for status, week_idxs in ((m.Update.COMPLETE, complete), (m.Update.ERRORED, errored)):
+            if week_idxs:
+                self.filter(user=user, type=type, status=m.Update.IN_PROGRESS, week_idx__in=week_idxs) \
+                    .update(status=status)
 
     def updating_users(self):
         """Returns a generator of (user, count of updates in progress)"""
@@ -41,16 +148,123 @@ class UpdateManager(models.Manager):
 # TODO: Drop any filtering done if dates given are the_beginning and today.
 class UserWeekDataManager(models.Manager):
 
+    # Every query here filters on user, and those over some weeks on
+    # week_idx, so that partitioned tables are pruned (see partitioning).
+
+    # Ways of writing a week's rows, see insert_weeks.
+    INSERT_ROWS = 'rows'
+    INSERT_BULK = 'bulk'
+    INSERT_COPY = 'copy'
+    INSERT_STRATEGIES = (INSERT_ROWS, INSERT_BULK, INSERT_COPY)
+
+    # Rows per INSERT statement when using bulk_create.
+    BULK_CHUNK_SIZE = 500
+
+    # Where weeks of artist plays are kept, see PackedWeekData.
+    STORE_ROWS = 'rows'
+    STORE_PACKED = 'packed'
+
+    def __init__(self, subject='artist'):
+        """subject is the name of the foreign key each row counts plays of."""
+        super(UserWeekDataManager, self).__init__()
+        self.subject = subject
+
+    def packed(self):
+        """Whether this manager's weeks are kept in PackedWeekData instead."""
+        return self.subject == 'artist' and \
+               getattr(settings, 'WEEK_DATA_STORAGE', self.STORE_ROWS) == self.STORE_PACKED
+
+    def default_insert_strategy(self):
+        """COPY on PostgreSQL, bulk_create elsewhere, unless configured."""
+        configured = getattr(settings, 'WEEK_DATA_INSERT_STRATEGY', None)
+        if configured:
+            return configured
+        return self.INSERT_COPY if connection.vendor == 'postgresql' else self.INSERT_BULK
+
+    def insert_weeks(self, user_id, weeks, strategy=None):
+        """
+        Writes many weeks of data for one user.  weeks is a dictionary of
+        week index to a dictionary of subject id to (plays, rank), as
+        returned by tasks' parsers.  Does no transaction handling of its
+        own; callers are expected to commit or roll back.  Returns the
+        number of rows written.
+        """
+        if self.packed():
+            return m.PackedWeekData.objects.insert_weeks(user_id, weeks)
+
+        strategy = strategy or self.default_insert_strategy()
+        subject_column = self.subject + '_id'
+        rows = [(week_idx, subject_id, plays, rank)
+                    for week_idx, wd in weeks.iteritems()
+                    for subject_id, (plays, rank) in wd.iteritems()]
+
+        if strategy == self.INSERT_ROWS:
+            for week_idx, subject_id, plays, rank in rows:
+                self.create(user_id=user_id, week_idx=week_idx, plays=plays, rank=rank,
+                            **{ subject_column : subject_id })
+
+        elif strategy == self.INSERT_BULK:
+            objs = [self.model(user_id=user_id, week_idx=week_idx, plays=plays, rank=rank,
+                               **{ subject_column : subject_id })
+                        for week_idx, subject_id, plays, rank in rows]
+            fields = [f for f in self.model._meta.local_fields if not f.primary_key]
+            batch_size = min(self.BULK_CHUNK_SIZE,
+                             max(connection.ops.bulk_batch_size(fields, objs), 1))
+            self.bulk_create(objs, batch_size=batch_size)
+
+        elif strategy == self.INSERT_COPY:
+            data = StringIO.StringIO()
+            for week_idx, subject_id, plays, rank in rows:
+                data.write("%d\t%d\t%d\t%d\t%d\n" % (user_id, week_idx, subject_id, plays, rank))
+            data.seek(0)
+            import psycopg2
+            cursor = connection.cursor()
+            try:
+                cursor.copy_from(data, self.model._meta.db_table,
+                        columns=('user_id', 'week_idx', subject_column, 'plays', 'rank'))
+            except psycopg2.IntegrityError, e:
+                # Raw cursors skip Django's wrapping of driver exceptions.
+                raise IntegrityError(*e.args)
+            # Django doesn't notice writes made through a raw cursor.
+            if transaction.is_managed():
+                transaction.set_dirty()
+            else:
+                transaction.commit_unless_managed()
+
+        else:
+            raise ValueError("Unknown insert strategy: %s" % (strategy,))
+
+        return len(rows)
+
     def __single_item(self, query):
         cursor = connection.cursor()
         cursor.execute(query)
         return cursor.fetchone()[0]
 
+    def week_rows(self, user_id, start=None, end=None, week_idxs=None):
+        """
+        Returns a user's rows as (week_idx, subject id, plays, rank) tuples in
+        order of week and rank, from weeks start to end or week_idxs if
+        given, wherever they're kept.
+        """
+        if self.packed():
+            return m.PackedWeekData.objects.week_rows(user_id, start, end, week_idxs)
+
+        query = self.filter(user=user_id)
+        if start is not None:
+            query = query.filter(week_idx__range=(start, end))
+        if week_idxs is not None:
+            query = query.filter(week_idx__in=week_idxs)
+        return list(query.order_by('week_idx', 'rank').values_list('week_idx', self.subject, 'plays', 'rank'))
+
     def total_plays(self, user):
+        if self.packed():
+            return sum(plays for _, _, plays, _ in self.week_rows(user)) or None
         return self.filter(user=user).aggregate(Sum('plays'))['plays__sum']
 
     def total_plays_between(self, user, start, end):
-        return self.user_weeks_between(user, start, end).aggregate(Sum('plays'))['plays__sum']
+        return m.UserWeekTotal.objects.user_weeks_between(user, start, end) \
+                .aggregate(Sum('total_plays'))['total_plays__sum']
 
     def user_weeks_between(self, user, start, end):
         """
@@ -58,7 +272,7 @@ class UserWeekDataManager(models.Manager):
         start and end.
         """
         base = self.filter(user=user.id)
-        if start != ldates.idx_beginning or end != ldates.idx_last_sunday:
+        if start != ldates.idx_beginning or end != ldates.index_of_last_sunday():
             if start == end:
                 return base.filter(week_idx=start)
             else:
@@ -67,16 +281,23 @@ class UserWeekDataManager(models.Manager):
             return base
 
     def first_available_week(self, user):
-        return self.filter(user=user).aggregate(Min('week_idx'))['week_idx__min']
+        objects = m.PackedWeekData.objects if self.packed() else self
+        return objects.filter(user=user).aggregate(Min('week_idx'))['week_idx__min']
 
     def record_weeks(self, user, start, end, num=10):
         """
         Returns a generator of artists most played in a single week between
         start and end.
         """
-        query = self.user_weeks_between(user, start, end).order_by('-plays')[:num]
-        for week in query:
-            date = ldates.date_of_index(week.week_idx)
+        if self.packed():
+            rows = heapq.nlargest(num, self.week_rows(user.id, start, end), key=itemgetter(2))
+            query = [self.model(user=user, week_idx=week_idx, artist_id=artist_id, plays=plays, rank=rank)
+                         for week_idx, artist_id, plays, rank in rows]
+        else:
+            query = self.user_weeks_between(user, start, end).order_by('-plays')[:num]
+        weeks = list(query)
+        dates = ldates.dates_of_indices([week.week_idx for week in weeks]).tolist()
+        for week, date in zip(weeks, dates):
             yield week, date
 
     def record_week_totals(self, user, start, end, num=10):
@@ -84,57 +305,55 @@ class UserWeekDataManager(models.Manager):
         Returns a generator of most songs played in any week between
         start and end.
         """
-        for idx, total in \
-                self.weekly_play_counts(user, start, end, num, order_by_plays=True):
-            yield idx, ldates.date_of_index(idx), total
+        weeks = list(self.weekly_play_counts(user, start, end, num, order_by_plays=True))
+        dates = ldates.dates_of_indices([idx for idx, _ in weeks]).tolist()
+        for (idx, total), date in zip(weeks, dates):
+            yield idx, date, total
 
     def record_unique_artists_in_week(self, user, start, end, num=10):
         """
         Returns a generator of weeks with most unique artists scrobbled.
         """
-        qs = self.user_weeks_between(user, start, end) \
-                 .values('week_idx') \
-                 .annotate(Count('artist')) \
-                 .order_by('-artist__count')[:num]
-        for r in qs:
-            idx = r['week_idx']
-            yield idx, ldates.date_of_index(idx), r['artist__count']
+        qs = list(m.UserWeekTotal.objects.user_weeks_between(user, start, end)
+                      .order_by('-unique_artists')[:num])
+        dates = ldates.dates_of_indices([r.week_idx for r in qs]).tolist()
+        for r, date in zip(qs, dates):
+            yield r.week_idx, date, r.unique_artists
+
+    def weekly_totals(self, user, start, end):
+        """
+        Returns [(week_idx, total_plays, unique_artists)] from the
+        UserWeekTotal rollup for the weeks between start and end that have
+        any plays, in week order.
+        """
+        # Weekly totals are cached a block of weeks at a time, keyed by the
+        # user's data version, so any range is made of the same few entries.
+        def fetch(first, last):
+            return list(m.UserWeekTotal.objects.filter(user=user.id, week_idx__range=(first, last))
+                            .order_by('week_idx').values_list('week_idx', 'total_plays', 'unique_artists'))
+        return [row for block in usercache.cached_blocks(user.id, 'week_totals', start, end, fetch)
+                    for row in block if start <= row[0] <= end]
 
     def weekly_play_counts(self, user, start, end, count=None, just_counts=False,
             order_by_plays=False):
+        weeks = [row[:2] for row in self.weekly_totals(user, start, end)]
 
-        # Use cache, fill cache if data not there.
-        cache_key = "%s:%d:%d:weekly_play_counts" % (user.username, start, end)
-        cached = cache.get(cache_key)
-        if not cached:
-            logging.info("Weekly play counts not in cache, fetching from database: " + cache_key)
-            qs = self.user_weeks_between(user, start, end) \
-                     .values('week_idx')                   \
-                     .annotate(Sum('plays'))               \
-                     .order_by('week_idx')
-
-            # list() forces evaluation of queryset.
-            cached = list(qs)
-            cache.set(cache_key, cached)
-        else:
-            logging.info("Found weekly playcounts in cache with key: " + cache_key)
         def y(i, pc):
             return pc if just_counts else (i, pc)
                 
         # last_index handles weeks when nothing was played
         if order_by_plays:
-            cached.sort(key=itemgetter('plays__sum'), reverse=True)
+            weeks.sort(key=itemgetter(1), reverse=True)
 
-        if count: cached = cached[:count]
+        if count: weeks = weeks[:count]
 
         last_index = start - 1
-        for d in cached:
-            index = d['week_idx']
+        for index, total in weeks:
             # need to catch up.
             if not order_by_plays and index != (last_index + 1):
                 for idx in xrange(last_index+1, index):
                     yield y(idx, 0)
-            yield y(index, d['plays__sum'])
+            yield y(index, total)
             last_index = index
 
     def weekly_play_counts_histogram(self, user, start, end, bins=10):
@@ -146,20 +365,142 @@ class UserWeekDataManager(models.Manager):
         return buckets, step
 
     def monthly_counts_js(self, user, start, end):
-        hist = [0] * 12
-        wpcs = self.weekly_play_counts(user, start, end)
-        for date, wpc in wpcs:
-            bucket = (ldates.date_of_index(date)).month - 1
-            hist[bucket] += wpc
-        return hist
+        wpcs = list(self.weekly_play_counts(user, start, end))
+        if not wpcs:
+            return [0] * 12
+        idxs, counts = zip(*wpcs)
+        buckets = ldates.months_of_indices(idxs) - 1
+        return np.bincount(buckets, weights=counts, minlength=12).astype(np.int64).tolist()
 
     def user_weekly_plays_of_artists(self, user_id, artist_id, start, end):
         """
         Returns a basic query set of a user's data filtered to plays of
         particular artists, between start and end.
         """
+        if self.subject == 'artist':
+            snap = snapshot.load(int(user_id))
+            if snap is not None:
+                snap = snap.between(int(start), int(end))
+                played = snap.artist_id == int(artist_id)
+                return zip(snap.week_idx[played].tolist(), snap.plays[played].tolist())
+
+        if self.packed():
+            artist_id = int(artist_id)
+            return [(week_idx, plays) for week_idx, subject_id, plays, _
+                        in self.week_rows(user_id, start, end) if subject_id == artist_id]
+
         query = self.filter(user=user_id, artist=artist_id).order_by('week_idx')
-        if start != ldates.idx_beginning or end != ldates.idx_last_sunday:
+        if start != ldates.idx_beginning or end != ldates.index_of_last_sunday():
             query = query.filter(week_idx__range=(start, end))
 
         return [(week_data.week_idx, week_data.plays) for week_data in query]
+
+
+class PackedWeekDataManager(models.Manager):
+    """
+    PackedWeekData in the shapes UserWeekDataManager reads and writes, which
+    hands over to it when WEEK_DATA_STORAGE is 'packed'.
+    """
+
+    def _lists(self, rows):
+        """Values of artists, plays and ranks, which values_list leaves as stored."""
+        to_python = self.model._meta.get_field('artists').to_python
+        for row in rows:
+            yield (row[0],) + tuple(to_python(v) for v in row[1:])
+
+    def insert_weeks(self, user_id, weeks):
+        """
+        As UserWeekDataManager.insert_weeks, writing one row per week.
+        Returns the number of artist rows that stands for.
+        """
+        objs = []
+        for week_idx, wd in weeks.iteritems():
+            ranked = sorted(wd.iteritems(), key=lambda (artist_id, (plays, rank)): (rank, artist_id))
+            objs.append(self.model(user_id=user_id, week_idx=week_idx,
+                                   artists=[artist_id for artist_id, _ in ranked],
+                                   plays=[plays for _, (plays, _) in ranked],
+                                   ranks=[rank for _, (_, rank) in ranked]))
+        self.bulk_create(objs, batch_size=UserWeekDataManager.BULK_CHUNK_SIZE)
+        return sum(len(wd) for wd in weeks.itervalues())
+
+    def week_rows(self, user_id, start=None, end=None, week_idxs=None):
+        """As UserWeekDataManager.week_rows."""
+        query = self.filter(user=user_id)
+        if start is not None:
+            query = query.filter(week_idx__range=(start, end))
+        if week_idxs is not None:
+            query = query.filter(week_idx__in=week_idxs)
+        rows = []
+        for week_idx, artists, plays, ranks in \
+                self._lists(query.order_by('week_idx').values_list('week_idx', 'artists', 'plays', 'ranks')):
+            rows.extend(zip([week_idx] * len(artists), artists, plays, ranks))
+        return rows
+
+    def week_totals(self, user_id):
+        """Returns [(week_idx, total plays, unique artists)] for every week the user has."""
+        return [(week_idx, sum(plays), len(plays)) for week_idx, plays in
+                    self._lists(self.filter(user=user_id).values_list('week_idx', 'plays'))]
+
+    def pack(self, user_id):
+        """
+        Replaces the user's packed weeks with their WeekData rows.  Does no
+        transaction handling of its own.  Returns the number of rows packed.
+        """
+        weeks = {}
+        for week_idx, artist_id, plays, rank in \
+                m.WeekData.objects.filter(user=user_id).values_list('week_idx', 'artist', 'plays', 'rank'):
+            weeks.setdefault(week_idx, {})[artist_id] = (plays, rank)
+        self.filter(user=user_id).delete()
+        return self.insert_weeks(user_id, weeks)
+
+    def unpack(self, user_id):
+        """
+        Replaces the user's WeekData rows with their packed weeks.  Does no
+        transaction handling of its own.  Returns the number of rows written.
+        """
+        objs = [m.WeekData(user_id=user_id, week_idx=week_idx, artist_id=artist_id, plays=plays, rank=rank)
+                    for week_idx, artist_id, plays, rank in self.week_rows(user_id)]
+        m.WeekData.objects.filter(user=user_id).delete()
+        m.WeekData.objects.bulk_create(objs, batch_size=UserWeekDataManager.BULK_CHUNK_SIZE)
+        return len(objs)
+
+
+class UserWeekTotalManager(models.Manager):
+
+    def user_weeks_between(self, user, start, end):
+        """A user's weekly totals between start and end."""
+        base = self.filter(user=user.id)
+        if start != ldates.idx_beginning or end != ldates.index_of_last_sunday():
+            base = base.filter(week_idx__range=(start, end))
+        return base
+
+    def record(self, user_id, weeks):
+        """
+        Writes totals for weeks, a dictionary of week index to a dictionary
+        of artist id to (plays, rank) as given to insert_weeks.  Does no
+        transaction handling of its own.
+        """
+        self.bulk_create([m.UserWeekTotal(user_id=user_id, week_idx=week_idx,
+                                          total_plays=sum(plays for plays, _ in wd.itervalues()),
+                                          unique_artists=len(wd))
+                             for week_idx, wd in weeks.iteritems()])
+
+    def rebuild(self, user_id):
+        """
+        Replaces a user's totals with ones freshly aggregated from WeekData.
+        Does no transaction handling of its own.  Returns the number of
+        weeks written.
+        """
+        self.filter(user=user_id).delete()
+        if m.WeekData.objects.packed():
+            rows = m.PackedWeekData.objects.week_totals(user_id)
+        else:
+            rows = [(r['week_idx'], r['plays__sum'], r['artist__count']) for r in
+                        m.WeekData.objects.filter(user=user_id)
+                            .values('week_idx')
+                            .annotate(Sum('plays'), Count('artist'))]
+        totals = [m.UserWeekTotal(user_id=user_id, week_idx=week_idx,
+                                  total_plays=total_plays, unique_artists=unique_artists)
+                      for week_idx, total_plays, unique_artists in rows]
+        self.bulk_create(totals)
+        return len(totals)
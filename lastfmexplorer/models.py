@@ -5,6 +5,7 @@ import caching.base
 
 import ldates
 import managers
+from utils import WeekSet
 
 from django.db import models
 
@@ -30,10 +31,57 @@ class TruncatingCharField(models.CharField):
 add_introspection_rules([], ["^twothreefall\.lastfmexplorer\.models\.TruncatingCharField"])
 
 
+class WeekSetField(models.TextField):
+    """
+    Stores a utils.WeekSet as its bits in hex.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        if isinstance(value, WeekSet):
+            return value
+        if not value:
+            return WeekSet()
+        if isinstance(value, (int, long)):
+            return WeekSet(value)
+        return WeekSet(long(value, 16))
+
+    def get_prep_value(self, value):
+        return "%x" % (self.to_python(value).bits,)
+add_introspection_rules([], ["^(twothreefall\.)?lastfmexplorer\.models\.WeekSetField"])
+
+
+class PackedIntegersField(models.Field):
+    """
+    Stores a list of integers as an integer[] on PostgreSQL, and as comma
+    separated text elsewhere.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def db_type(self, connection):
+        return 'integer[]' if connection.vendor == 'postgresql' else 'text'
+
+    def to_python(self, value):
+        if isinstance(value, list):
+            return value
+        if not value:
+            return []
+        if isinstance(value, basestring):
+            return map(int, value.split(","))
+        return list(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = self.to_python(value)
+        if connection.vendor == 'postgresql':
+            return value
+        return ",".join(map(str, value))
+add_introspection_rules([], ["^(twothreefall\.)?lastfmexplorer\.models\.PackedIntegersField"])
+
+
 class Artist(caching.base.CachingMixin, models.Model):
     name = TruncatingCharField(max_length=MAX_ARTIST_NAME_LENGTH, unique=True)
 
-    objects = caching.base.CachingManager()
+    objects = managers.ArtistManager()
 
     def __unicode__(self):
         return self.name
@@ -63,6 +111,8 @@ class Track(models.Model):
     artist = models.ForeignKey(Artist)
     title  = TruncatingCharField(max_length=100)
 
+    objects = managers.TrackManager()
+
     def get_absolute_url(self):
         return "%s/music/%s/_/%s" % (_LASTFM, self.artist, self.title)
 
@@ -85,8 +135,12 @@ class User(caching.base.CachingMixin, models.Model):
     last_updated = models.DateField()
     deleted    = models.BooleanField(default=False)
     image      = models.URLField()
+    # Weeks whose artist charts have been saved, and those with at least one
+    # WeekData row.  Kept up to date as weeks are saved.
+    weeks_fetched = WeekSetField(default='0')
+    weeks_with_data = WeekSetField(default='0')
 
-    objects    = caching.base.CachingManager()
+    objects    = managers.UserManager()
 
     class Meta:
         ordering = ['username']
@@ -101,13 +155,23 @@ class User(caching.base.CachingMixin, models.Model):
 
     @property
     def days_registered(self):
-        return (dt.date.today() - self.registered).days
+        return (ldates.today() - self.registered).days
 
     @property
     def first_sunday_with_data(self):
         """Returns week index of first Sunday after user's registration"""
         return ldates.first_sunday_on_or_after(self.registered)
 
+    @property
+    def first_available_week(self):
+        """Index of the first week the user has data for, or None."""
+        return self.weeks_with_data.first()
+
+    @property
+    def last_available_week(self):
+        """Index of the last week the user has data for, or None."""
+        return self.weeks_with_data.last()
+
     @staticmethod
     def valid_username(name):
         return re.match("^%s$" % (USER_REGEX,), name) is not None
@@ -138,6 +202,10 @@ class Update(models.Model):
 
     objects = managers.UpdateManager()
 
+    class Meta:
+        # is_updating, weeks_fetched and finish filter on these.
+        index_together = [['user', 'status', 'type']]
+
     def __unicode__(self):
         return "%s:%s:%d:%s" % \
                (self.user, self.TYPES[self.type][1], self.week_idx, self.STATUSES[self.status][1])
@@ -163,6 +231,47 @@ class WeekData(models.Model):
         unique_together = ('user', 'week_idx', 'artist')
 
 
+class UserWeekTotal(models.Model):
+    """
+    Total plays and artists played per user per week, written alongside
+    each week's WeekData so aggregates needn't scan it.
+    """
+    user   = models.ForeignKey(User)
+    week_idx = models.PositiveSmallIntegerField()
+    total_plays = models.PositiveIntegerField()
+    unique_artists = models.PositiveIntegerField()
+
+    objects = managers.UserWeekTotalManager()
+
+    def __unicode__(self):
+        return "%s/%d/%d/%d" % \
+                (self.user.username, self.week_idx, self.total_plays, self.unique_artists)
+
+    class Meta:
+        unique_together = ('user', 'week_idx')
+
+
+class PackedWeekData(models.Model):
+    """
+    Weekly artist plays per user, all of a week in one row: WeekData's
+    storage when settings.WEEK_DATA_STORAGE is 'packed'.  artists, plays and
+    ranks are parallel lists in rank order.
+    """
+    user     = models.ForeignKey(User)
+    week_idx = models.PositiveSmallIntegerField()
+    artists  = PackedIntegersField()
+    plays    = PackedIntegersField()
+    ranks    = PackedIntegersField()
+
+    objects = managers.PackedWeekDataManager()
+
+    def __unicode__(self):
+        return "%s/%d/%d artists" % (self.user.username, self.week_idx, len(self.artists))
+
+    class Meta:
+        unique_together = ('user', 'week_idx')
+
+
 class WeekTrackData(models.Model):
     """
     Weekly track plays per user
@@ -173,7 +282,7 @@ class WeekTrackData(models.Model):
     plays  = models.PositiveIntegerField()
     rank   = models.PositiveIntegerField()
 
-    objects = managers.UserWeekDataManager()
+    objects = managers.UserWeekDataManager(subject='track')
 
     def __unicode__(self):
         return "%s/%d/%s/%d" %\
@@ -0,0 +1,146 @@
+"""
+Optional declarative partitioning of the week data tables on PostgreSQL.
+
+settings.WEEKDATA_PARTITIONING picks the layout:
+
+  'user' -- hash partitions on user_id, settings.WEEKDATA_PARTITIONS of them
+            (16 by default).
+  'year' -- range partitions on week_idx, one per calendar year, plus a
+            default partition for weeks past the last year made.
+
+Every manager query filters on user_id, and those over a range of weeks on
+week_idx, so with either layout PostgreSQL only visits the partitions that
+can hold the rows asked for.  Partitioned tables need the partition key in
+their primary key and unique constraints, so the primary key becomes (id,
+key); the (user_id, week_idx, subject) unique constraint already has both.
+
+Needs PostgreSQL 11 or later.  Migration 0010 converts the tables when the
+setting is on, and the partition_weekdata command converts them afterwards.
+"""
+from datetime import date
+
+from django.conf import settings
+
+import ldates
+
+BY_USER = 'user'
+BY_YEAR = 'year'
+LAYOUTS = (BY_USER, BY_YEAR)
+
+# table: (subject column, subject table, whether it has migration 0009's covering indexes)
+TABLES = {
+    'lastfmexplorer_weekdata': ('artist_id', 'lastfmexplorer_artist', True),
+    'lastfmexplorer_weektrackdata': ('track_id', 'lastfmexplorer_track', False),
+}
+
+
+def layout():
+    return getattr(settings, 'WEEKDATA_PARTITIONING', None)
+
+def partition_count():
+    return getattr(settings, 'WEEKDATA_PARTITIONS', 16)
+
+
+def check_server(cursor):
+    cursor.execute("SHOW server_version_num")
+    if int(cursor.fetchone()[0]) < 110000:
+        raise ValueError("Partitioning week data needs PostgreSQL 11 or later")
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [table])
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def create_partitioned(cursor, table, like, by, partitions=None, last_year=None):
+    """
+    Creates table with the columns and defaults of like, partitioned as by
+    says.  Constraints and indexes are left to add_constraints, which is
+    quicker once rows are in.
+    """
+    partitions = partitions or partition_count()
+    last_year = last_year or ldates.today().year + 1
+    if by == BY_USER:
+        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY HASH (user_id)"
+                       % (table, like))
+        for remainder in xrange(partitions):
+            cursor.execute("CREATE TABLE %s_p%d PARTITION OF %s FOR VALUES WITH (MODULUS %d, REMAINDER %d)"
+                           % (table, remainder, table, partitions, remainder))
+    elif by == BY_YEAR:
+        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (week_idx)"
+                       % (table, like))
+        for year in xrange(ldates.the_beginning.year, last_year + 1):
+            first, end = ldates.fsooa(date(year, 1, 1)), ldates.fsooa(date(year + 1, 1, 1))
+            cursor.execute("CREATE TABLE %s_y%d PARTITION OF %s FOR VALUES FROM (%d) TO (%d)"
+                           % (table, year, table, first, end))
+        cursor.execute("CREATE TABLE %s_default PARTITION OF %s DEFAULT" % (table, table))
+    else:
+        raise ValueError("Unknown partitioning %r, expected one of %s" % (by, ", ".join(LAYOUTS)))
+
+
+def add_constraints(cursor, table, subject, subject_table, covering, by=None, foreign_keys=True):
+    """
+    Gives table the keys and indexes of the week data tables.  by is the
+    partitioning, whose key has to join id in the primary key, or None.
+    """
+    key = {BY_USER: ', user_id', BY_YEAR: ', week_idx', None: ''}[by]
+    name = table.replace('lastfmexplorer_', '')
+    cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id%s)" % (table, key))
+    cursor.execute("ALTER TABLE %s ADD UNIQUE (user_id, week_idx, %s)" % (table, subject))
+    for column in ('user_id', subject, 'week_idx'):
+        cursor.execute("CREATE INDEX %s_%s ON %s (%s)" % (name, column, table, column))
+    if covering:
+        cursor.execute("CREATE INDEX %s_user_week_plays ON %s (user_id, week_idx) INCLUDE (%s, plays)"
+                       % (name, table, subject))
+        cursor.execute("CREATE INDEX %s_user_%s_week ON %s (user_id, %s, week_idx) INCLUDE (plays)"
+                       % (name, subject.replace('_id', ''), table, subject))
+    if foreign_keys:
+        for column, target in (('user_id', 'lastfmexplorer_user'), (subject, subject_table)):
+            cursor.execute("ALTER TABLE %s ADD FOREIGN KEY (%s) REFERENCES %s (id) DEFERRABLE INITIALLY DEFERRED"
+                           % (table, column, target))
+
+
+def _replace(cursor, table, create, by):
+    """
+    Swaps table for a new one made by create(cursor, name), copying its rows
+    and handing over its id sequence.
+    """
+    subject, subject_table, covering = TABLES[table]
+    new = table + "_new"
+    create(cursor, new)
+    cursor.execute("INSERT INTO %s SELECT * FROM %s" % (new, table))
+    cursor.execute("ALTER SEQUENCE %s_id_seq OWNED BY %s.id" % (table, new))
+    cursor.execute("DROP TABLE %s" % (table,))
+    cursor.execute("ALTER TABLE %s RENAME TO %s" % (new, table))
+    if by:
+        # Partitions were named after the new table.
+        cursor.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass",
+                       [table])
+        for (partition,) in cursor.fetchall():
+            cursor.execute("ALTER TABLE %s RENAME TO %s" % (partition, partition.replace(new, table, 1)))
+    add_constraints(cursor, table, subject, subject_table, covering, by)
+    cursor.execute("ANALYZE %s" % (table,))
+
+
+def partition(cursor, table, by, partitions=None):
+    """
+    Converts table to the partitioned layout by.  Returns False, doing
+    nothing, if it's already partitioned.
+    """
+    check_server(cursor)
+    if is_partitioned(cursor, table):
+        return False
+    _replace(cursor, table, lambda c, new: create_partitioned(c, new, table, by, partitions), by)
+    return True
+
+
+def unpartition(cursor, table):
+    """
+    Converts table back to a plain table.  Returns False, doing nothing, if
+    it isn't partitioned.
+    """
+    if not is_partitioned(cursor, table):
+        return False
+    _replace(cursor, table,
+             lambda c, new: c.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (new, table)), None)
+    return True
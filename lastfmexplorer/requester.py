@@ -1,16 +1,205 @@
 import StringIO
 import gzip
+import hashlib
+import httplib
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
 import urllib2
+import urlparse
 import logging
 import traceback
 
+from email.utils import parsedate_tz, mktime_tz
 from httplib import BadStatusLine
 from urllib import urlencode
 
+from django.conf import settings
+from django.core.cache import cache
+
 from twothreefall.settings import LASTFM_API_KEY
 
+
+class ConnectionPool(object):
+    """
+    Keeps idle HTTP/1.1 connections open so that requests to the same host
+    reuse them rather than paying for DNS and TCP setup each time.  At most
+    size idle connections are kept per host.  Thread safe.
+    """
+
+    def __init__(self, size=4, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self.connections_made = 0
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    def __checkout(self, host, port):
+        """Returns (connection, whether it has been used before)."""
+        with self.__lock:
+            idle = self.__idle.get((host, port))
+            if idle:
+                return idle.pop(), True
+            self.connections_made += 1
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def __checkin(self, host, port, conn):
+        with self.__lock:
+            idle = self.__idle.setdefault((host, port), [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def get(self, url, headers=None):
+        """
+        GETs url.  Returns (status, reason, dictionary of lower cased headers,
+        body).  Raises httplib.HTTPException or socket.error on failure.
+        """
+        parts = urlparse.urlsplit(url)
+        host, port = parts.hostname, parts.port or httplib.HTTP_PORT
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        while True:
+            conn, reused = self.__checkout(host, port)
+            try:
+                conn.request('GET', path, headers=headers or {})
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # The server may have dropped an idle connection, try a fresh one.
+                if reused:
+                    continue
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.__checkin(host, port, conn)
+            return response.status, response.reason, dict(response.getheaders()), body
+
+    def clear(self):
+        """Closes every idle connection."""
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() so no more than rate of them return each
+    second, however many threads are calling it.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        with self.__lock:
+            now = time.time()
+            slot = max(now, self.__next)
+            self.__next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class TokenBucket(object):
+    """
+    A rate limit shared by every process using the same cache, i.e. every
+    celery worker talking to our memcached.  The bucket holds rate tokens
+    and is refilled at the start of every second.  Tokens are counted with
+    the cache's atomic add and incr, so no locking is needed.
+    """
+
+    def __init__(self, name, rate, cache=None, clock=time.time):
+        self.name = name
+        self.rate = rate
+        self.cache = cache
+        self.clock = clock
+
+    def try_take(self):
+        """
+        Takes a token if one's left this second.  Returns the number of
+        seconds to wait before trying again, or 0 if a token was taken.
+        """
+        backend = self.cache or cache
+        now = self.clock()
+        key = "%s:%d" % (self.name, int(now))
+        backend.add(key, 0, timeout=5)
+        try:
+            taken = backend.incr(key)
+        except ValueError:
+            # The cache lost the count, or can't count.  Don't hold up
+            # requests for want of a limit.
+            logging.warning("Rate limit %s can't be counted, not limiting" % (self.name,))
+            return 0
+        if taken <= self.rate:
+            return 0
+        return int(now) + 1 - now
+
+    def take(self):
+        """Blocks until a token is taken."""
+        wait = self.try_take()
+        while wait:
+            # Jitter so waiting workers don't all retry at once.
+            time.sleep(wait + random.uniform(0, 0.1))
+            wait = self.try_take()
+
+
+# Statuses that mean try again later.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def backoff_delay(attempt, retry_after=None, base=1, cap=60):
+    """
+    Seconds to wait before retrying after attempt failed.  Honours the
+    server's Retry-After if given, otherwise exponential backoff with full
+    jitter.  Never more than cap.
+    """
+    if retry_after is not None:
+        return min(retry_after, cap)
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+def retry_after(headers):
+    """
+    Seconds a Retry-After header in headers asks us to wait, or None.  Can
+    be in seconds or an HTTP date.
+    """
+    value = headers.get('retry-after') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time.time())
+
+
+_POOL = None
+
+def connection_pool():
+    """The connection pool shared by every requester in this process."""
+    global _POOL
+    if _POOL is None:
+        _POOL = ConnectionPool(size=getattr(settings, 'LASTFM_POOL_SIZE', 4),
+                               timeout=getattr(settings, 'LASTFM_TIMEOUT', 60))
+    return _POOL
+
+
 class Requester:
 
+    # Identifies this requester to workers, see requester_for_key.
+    key = None
+
     def __init__(self, saveResponses=False):
         # TODO: Last.fm seems to have disabled gzip encoding?!
         self.shouldGzip = False
@@ -20,7 +209,14 @@ class Requester:
         """To be overriden by subclasses"""
         raise NotImplementedError("Should be overriden by subclass")
 
-    # TODO: Handle HTTP 503s.
+    def throttle(self):
+        """Called before every request.  To be overriden by rate limited subclasses."""
+        pass
+
+    def back_off(self, attempt, retry_after):
+        """Called after a failed attempt that may be retried."""
+        pass
+
     def make(self, method, extras=None):
         """
         Requests data from Last.fm.
@@ -30,20 +226,17 @@ class Requester:
         query = self.url_for_request(method, extras)
         logging.info(query)
 
-        req = urllib2.Request(query)
-        if self.shouldGzip:
-            req.add_header('Accept-encoding', 'gzip')
-        req.add_header('User-agent', 'Last.fm Explorer')
-
         result = { 'success' : False }
 
-        max_retries = 2 
+        max_retries = getattr(settings, 'LASTFM_MAX_RETRIES', 4)
         attempt     = 0
 
         while not result['success'] and attempt < max_retries:
             attempt += 1
+            wait = None
+            self.throttle()
             try:
-                r = urllib2.urlopen(req, timeout=60).read()
+                r = self.__fetch(query)
                 result['data'] = self.__unzip(r) if self.shouldGzip else r
                 result['success'] = True
                 if self.saveResponses:
@@ -52,6 +245,10 @@ class Requester:
             except urllib2.HTTPError, e:
                 logging.error("Requestor errored accessing " + query + " - " + str(e.code))
                 result['error'] = { 'code' : e.code, 'message' : e.msg }
+                # No point asking again for something that doesn't exist.
+                if e.code not in RETRY_STATUSES:
+                    break
+                wait = retry_after(e.hdrs)
 
             except urllib2.URLError, e:
                 logging.error("Requestor failed to fetch " + query + ' - URLError.')
@@ -70,8 +267,30 @@ class Requester:
                 logging.error(traceback.format_exc())
                 result['error'] = { 'messasge' : "Unknown problem" }
 
+            if not result['success'] and attempt < max_retries:
+                self.back_off(attempt, wait)
+
         return result
 
+    def __fetch(self, query):
+        """
+        Returns the body of the response to query.  HTTP goes through the
+        shared connection pool, anything else (e.g. file://) through
+        urllib2.  Raises urllib2.HTTPError for HTTP error statuses.
+        """
+        headers = { 'User-agent' : 'Last.fm Explorer' }
+        if self.shouldGzip:
+            headers['Accept-encoding'] = 'gzip'
+
+        if query.startswith('http://'):
+            status, reason, response_headers, body = connection_pool().get(query, headers)
+            if status >= 400:
+                raise urllib2.HTTPError(query, status, reason, response_headers, None)
+            return body
+        else:
+            req = urllib2.Request(query, headers=headers)
+            return urllib2.urlopen(req, timeout=connection_pool().timeout).read()
+
     def __save_response(self, method, extras, data):
         """Writes given data to disk"""
 
@@ -94,14 +313,37 @@ class Requester:
 
 
 class LastFMRequester(Requester):
-    """Proper requests to Last.fm"""
+    """
+    Proper requests to Last.fm, or to anything pretending to be Last.fm at
+    root (see standin.py).
+    """
 
-    def __init__(self):
+    key = 'lastfm'
+    ROOT = "http://ws.audioscrobbler.com/2.0/"
+
+    def __init__(self, root=ROOT, rate=None):
+        """
+        rate is requests per second allowed to root across every process,
+        defaulting to settings.LASTFM_REQUESTS_PER_SECOND.
+        """
         Requester.__init__(self, saveResponses=False)
+        self.root = root
+        if root != self.ROOT:
+            self.key = 'lastfm:' + root
+        self.bucket = TokenBucket('lastfm-requests:' + root,
+                rate or getattr(settings, 'LASTFM_REQUESTS_PER_SECOND', 5))
+
+    def throttle(self):
+        self.bucket.take()
+
+    def back_off(self, attempt, retry_after):
+        delay = backoff_delay(attempt, retry_after, base=getattr(settings, 'LASTFM_BACKOFF_BASE', 1))
+        logging.info("Backing off %.1fs after attempt %d" % (delay, attempt))
+        time.sleep(delay)
 
     def url_for_request(self, method, extras):
         args = urlencode(extras) if extras else ""
-        return "http://ws.audioscrobbler.com/2.0/?method=%s&api_key=%s&%s" % (method, LASTFM_API_KEY, args)
+        return "%s?method=%s&api_key=%s&%s" % (self.root, method, LASTFM_API_KEY, args)
 
 
 class TestRequester(Requester):
@@ -110,13 +352,136 @@ class TestRequester(Requester):
     def __init__(self, rootDataDir):
         Requester.__init__(self, saveResponses=False)
         self.rootDataDir = rootDataDir
+        self.key = 'test:' + rootDataDir
 
     def url_for_request(self, method, extras):
-        if method == 'user.getweeklychartlist':
-            testFile = "%s/weeklychartlist.xml" % (extras['user'],)
-        elif method == 'user.getweeklyartistchart':
-            testFile = "%(user)s/%(from)s-%(to)s.xml" % extras
-        else:
-            raise ValueError("Unknown method %s given to TestRequester" % (method,))
-        
-        return "file://%s/%s/%s" % (self.rootDataDir, method, testFile)
+        return "file://%s/%s" % (self.rootDataDir, test_data_path(method, extras))
+
+
+class CachingRequester(Requester):
+    """
+    Wraps another requester, keeping its responses for weeks that have ended
+    in a compressed store on disk.  Last.fm never changes a past week's
+    chart, so stored responses are never replaced or expired, and a
+    re-import or reparse of a user needs no requests at all.  With offline
+    set anything not stored fails rather than going to the wrapped
+    requester, for replaying a corpus of responses.
+    """
+
+    # Only charts of a fixed week are safe to keep forever.
+    CACHEABLE = ('user.getweeklyartistchart', 'user.getweeklytrackchart', 'user.getweeklyalbumchart')
+
+    def __init__(self, requester, root, offline=False, clock=time.time):
+        Requester.__init__(self, saveResponses=False)
+        self.requester = requester
+        self.root = root
+        self.offline = offline
+        self.clock = clock
+        self.key = 'cached:%s|%s' % (root, requester.key)
+        self.hits = 0
+        self.misses = 0
+
+    def url_for_request(self, method, extras):
+        return self.requester.url_for_request(method, extras)
+
+    def path_for(self, method, extras):
+        """Where the response to this request is kept, or None if it can't be kept."""
+        if method not in self.CACHEABLE or int(extras['to']) > self.clock():
+            return None
+        name = hashlib.sha1("%s|%s|%s|%s" % (method, extras['user'], extras['from'], extras['to'])).hexdigest()
+        return os.path.join(self.root, name[:2], name + '.xml.gz')
+
+    def make(self, method, extras=None):
+        path = self.path_for(method, extras)
+        if path and os.path.exists(path):
+            self.hits += 1
+            with gzip.open(path, 'rb') as f:
+                return { 'success' : True, 'data' : f.read() }
+
+        self.misses += 1
+        if self.offline:
+            return { 'success' : False, 'error' : { 'message' : "Not in response cache" } }
+
+        result = self.requester.make(method, extras)
+        # Last.fm sometimes sends errors with a 200.
+        if path and result['success'] and 'status="ok"' in result['data'][:200]:
+            self.__store(path, result['data'])
+        return result
+
+    def __store(self, path, data):
+        """
+        Writes data compressed to path, atomically so readers never see half
+        a file.  A response that can't be stored is logged and left out.
+        """
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Made by another worker meanwhile.
+                    pass
+            fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        except (IOError, OSError), e:
+            logging.error("Couldn't store response in %s: %s" % (path, e))
+            return
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                    f.write(data)
+            # mkstemp makes files only its owner can read.
+            os.chmod(temporary, 0644)
+            os.rename(temporary, path)
+        except (IOError, OSError), e:
+            logging.error("Couldn't store response in %s: %s" % (path, e))
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
+
+def test_data_path(method, extras):
+    """Path of the file in test-data holding the response to a request."""
+    if method == 'user.getweeklychartlist':
+        testFile = "%s/weeklychartlist.xml" % (extras['user'],)
+    elif method in ('user.getweeklyartistchart', 'user.getweeklytrackchart'):
+        testFile = "%(user)s/%(from)s-%(to)s.xml" % extras
+    else:
+        raise ValueError("Unknown method %s given to TestRequester" % (method,))
+
+    return "%s/%s" % (method, testFile)
+
+
+
+###############################################################################
+# Celery tasks are given a requester's key rather than the requester itself.
+# Keys are 'kind' or 'kind:argument'.
+
+def _caching_requester(argument):
+    root, _, key = argument.partition('|')
+    return CachingRequester(requester_for_key(key), root)
+
+_FACTORIES = {
+    'lastfm' : lambda root: LastFMRequester(root) if root else LastFMRequester(),
+    'test' : TestRequester,
+    'cached' : _caching_requester,
+}
+
+_REQUESTERS = {}
+
+def register(requester):
+    """Makes requester the one used for its key in this process. Returns the key."""
+    _REQUESTERS[requester.key] = requester
+    return requester.key
+
+def requester_for_key(key):
+    """Returns the requester for key, building it if this process has none."""
+    try:
+        return _REQUESTERS[key]
+    except KeyError:
+        kind, _, argument = key.partition(':')
+        if kind not in _FACTORIES:
+            raise ValueError("Unknown requester key %s" % (key,))
+        requester = _FACTORIES[kind](argument)
+        register(requester)
+        return requester
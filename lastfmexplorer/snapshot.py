@@ -0,0 +1,296 @@
+"""
+Columnar snapshots of users' WeekData.
+
+A user's snapshot is a single .npy file holding a 4 x n array of int32: the
+week_idx, artist_id, plays and rank of each of their WeekData rows, sorted by
+week.  Each row of the array is one contiguous column, so the file can be
+memory-mapped read-only by every process and sliced to a range of weeks with a
+binary search instead of a query.
+
+Next to it, <user_id>.blocks.npy holds BlockTotals: the plays of each of the
+user's artists summed over blocks of BLOCK_WEEKS weeks as running totals, so
+any range of weeks can be totalled per artist without reading every row.
+
+Snapshots live under settings.LASTFM_SNAPSHOT_DIR and are disabled when it
+isn't set.  While a user's weeks are being fetched their snapshot is
+discarded, and it's brought up to date once the last of the fetch is saved
+(see tasks._snapshot_saved): the new file is written alongside and renamed
+over the old one, so readers always see a whole snapshot.
+"""
+import fcntl
+import os
+import tempfile
+
+import numpy as np
+
+from django.conf import settings
+
+import models as m
+from utils import LRUCache
+
+WEEK_IDX, ARTIST_ID, PLAYS, RANK = range(4)
+FIELDS = ('week_idx', 'artist', 'plays', 'rank')
+
+BLOCK_WEEKS = 13
+
+# Mappings kept per process.  Each holds its file open, replaced or not, so
+# only the most recently used users' are kept.
+LOADED_USERS = 64
+_LOADED = LRUCache(maxsize=LOADED_USERS)
+_LOADED_TOTALS = LRUCache(maxsize=LOADED_USERS)
+
+
+class Snapshot(object):
+    """
+    Parallel columns of a user's rows.  Slicing with between() gives views
+    onto the same memory-mapped file.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.week_idx = columns[WEEK_IDX]
+        self.artist_id = columns[ARTIST_ID]
+        self.plays = columns[PLAYS]
+        self.rank = columns[RANK]
+
+    def between(self, start, end):
+        """The rows for weeks start to end inclusive."""
+        lo = np.searchsorted(self.week_idx, start, side='left')
+        hi = np.searchsorted(self.week_idx, end, side='right')
+        return Snapshot(self.columns[:, lo:hi])
+
+    def weeks(self):
+        return np.unique(self.week_idx)
+
+    def __len__(self):
+        return self.columns.shape[1]
+
+    def __repr__(self):
+        return "<Snapshot:%d rows>" % (len(self),)
+
+
+class BlockTotals(object):
+    """
+    Per artist plays of a snapshot, totalled by block.  cumulative[k] is the
+    plays of each of artist_ids in weeks before k * block_weeks, so the
+    totals over any range are a difference of two rows plus the rows of the
+    partial blocks at either end, which are less than a block each.
+    """
+
+    def __init__(self, snapshot, artist_ids, cumulative, block_weeks=BLOCK_WEEKS):
+        self.snapshot = snapshot
+        self.artist_ids = artist_ids
+        self.cumulative = cumulative
+        self.block_weeks = block_weeks
+
+    @classmethod
+    def of_snapshot(cls, snapshot, block_weeks=BLOCK_WEEKS):
+        if not len(snapshot):
+            return cls(snapshot, np.zeros(0, dtype=np.int32),
+                       np.zeros((1, 0), dtype=np.int32), block_weeks)
+        artist_ids, columns = np.unique(snapshot.artist_id, return_inverse=True)
+        blocks = int(snapshot.week_idx[-1]) / block_weeks + 1
+        cells = snapshot.week_idx.astype(np.int64) / block_weeks * len(artist_ids) + columns
+        sums = np.bincount(cells, weights=snapshot.plays, minlength=blocks * len(artist_ids))
+        cumulative = np.zeros((blocks + 1, len(artist_ids)), dtype=np.int32)
+        cumulative[1:] = np.cumsum(sums.astype(np.int64).reshape(blocks, len(artist_ids)), axis=0)
+        return cls(snapshot, artist_ids.astype(np.int32), cumulative, block_weeks)
+
+    def _add_rows(self, totals, start, end):
+        rows = self.snapshot.between(start, end) if start <= end else ()
+        if len(rows):
+            columns = np.searchsorted(self.artist_ids, rows.artist_id)
+            totals += np.bincount(columns, weights=rows.plays,
+                                  minlength=len(self.artist_ids)).astype(totals.dtype)
+
+    def between(self, start, end):
+        """
+        Returns the plays of each of artist_ids in weeks start to end
+        inclusive.
+        """
+        totals = np.zeros(len(self.artist_ids), dtype=np.int64)
+        start = max(start, 0)
+        if start > end:
+            return totals
+        blocks = len(self.cumulative) - 1
+        first = min(-(-start / self.block_weeks), blocks)
+        last = min((end + 1) / self.block_weeks, blocks)
+        if first < last:
+            totals += self.cumulative[last]
+            totals -= self.cumulative[first]
+            self._add_rows(totals, start, first * self.block_weeks - 1)
+            self._add_rows(totals, last * self.block_weeks, end)
+        else:
+            self._add_rows(totals, start, end)
+        return totals
+
+    def top(self, totals, count, where=None):
+        """
+        Returns [(artist id, plays)] of the count artists with most plays in
+        totals, an array from between, optionally only considering those where
+        is True.  Artists without plays are left out.
+        """
+        if count <= 0:
+            return []
+        chosen = totals > 0
+        if where is not None:
+            chosen &= where
+        candidates = np.flatnonzero(chosen)
+        if len(candidates) > count:
+            candidates = candidates[np.argpartition(-totals[candidates], count - 1)[:count]]
+        candidates = candidates[np.argsort(-totals[candidates], kind='mergesort')]
+        return zip(self.artist_ids[candidates].tolist(), totals[candidates].tolist())
+
+    def __repr__(self):
+        return "<BlockTotals:%d artists, %d blocks>" % (len(self.artist_ids), len(self.cumulative) - 1)
+
+
+def root():
+    return getattr(settings, 'LASTFM_SNAPSHOT_DIR', None)
+
+def enabled():
+    return bool(root())
+
+def path_of(user_id):
+    return os.path.join(root(), "%d.npy" % (user_id,))
+
+
+def load(user_id):
+    """
+    Returns the user's snapshot, memory-mapped, or None if snapshots are
+    disabled or the user hasn't got one.  Mappings are kept for as long as the
+    file isn't replaced.
+    """
+    if not enabled():
+        return None
+    path = path_of(user_id)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    version = (stat.st_ino, stat.st_mtime, stat.st_size)
+    loaded = _LOADED.get_many([user_id]).get(user_id)
+    if loaded and loaded[0] == version:
+        return loaded[1]
+    try:
+        snapshot = Snapshot(np.load(path, mmap_mode='r'))
+    except (IOError, ValueError):
+        return None
+    _LOADED.set_many({user_id: (version, snapshot)})
+    return snapshot
+
+
+def blocks_path_of(user_id):
+    return os.path.join(root(), "%d.blocks.npy" % (user_id,))
+
+
+def load_totals(user_id):
+    """
+    Returns BlockTotals for the user's snapshot, or None if they haven't got
+    one.  The blocks file is only trusted if it adds up to the snapshot it's
+    paired with, otherwise the totals are worked out here from the snapshot.
+    """
+    snapshot = load(user_id)
+    if snapshot is None:
+        return None
+
+    loaded = _LOADED_TOTALS.get_many([user_id]).get(user_id)
+    if loaded and loaded.snapshot is snapshot:
+        return loaded
+
+    totals = None
+    try:
+        stored = np.load(blocks_path_of(user_id), mmap_mode='r')
+        if stored[1:].shape[0] and int(stored[-1].sum(dtype=np.int64)) == int(snapshot.plays.sum(dtype=np.int64)):
+            totals = BlockTotals(snapshot, stored[0], stored[1:])
+    except (IOError, ValueError):
+        pass
+    if totals is None:
+        totals = BlockTotals.of_snapshot(snapshot)
+
+    _LOADED_TOTALS.set_many({user_id: totals})
+    return totals
+
+
+def _columns_of(rows):
+    return np.array(rows, dtype=np.int32).reshape(-1, len(FIELDS)).T
+
+
+def _save(user_id, path, array):
+    fd, tmp = tempfile.mkstemp(dir=root(), prefix=".%d." % (user_id,), suffix=".npy")
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            np.save(out, np.ascontiguousarray(array, dtype=np.int32))
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _write(user_id, columns):
+    # Blocks first: until the snapshot is replaced too, readers notice the
+    # blocks don't match it and work totals out from the snapshot.
+    totals = BlockTotals.of_snapshot(Snapshot(columns))
+    _save(user_id, blocks_path_of(user_id), np.vstack((totals.artist_ids, totals.cumulative)))
+    _save(user_id, path_of(user_id), columns)
+
+
+class _Locked(object):
+    """Serialises rebuilds of one user's snapshot across processes."""
+
+    def __init__(self, user_id):
+        self.path = os.path.join(root(), "%d.lock" % (user_id,))
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+
+def build(user_id):
+    """Writes a snapshot of all the user's rows.  Returns the number of rows."""
+    if not os.path.isdir(root()):
+        os.makedirs(root())
+    with _Locked(user_id):
+        columns = _columns_of(m.WeekData.objects.week_rows(user_id))
+        _write(user_id, columns)
+    return columns.shape[1]
+
+
+def discard(user_id):
+    """
+    Removes the user's snapshot, if they have one, so that queries are used
+    until it's built again.
+    """
+    if not os.path.exists(path_of(user_id)):
+        return
+    with _Locked(user_id):
+        try:
+            os.unlink(path_of(user_id))
+        except OSError:
+            pass
+
+
+def update(user_id, week_idxs):
+    """
+    Brings the user's snapshot up to date after week_idxs were saved, reading
+    only those weeks from the database.  Builds it from scratch if the user
+    hasn't a snapshot yet.  Returns the number of rows in the snapshot.
+    """
+    if not os.path.exists(path_of(user_id)):
+        return build(user_id)
+
+    week_idxs = sorted(week_idxs)
+    with _Locked(user_id):
+        existing = np.load(path_of(user_id))
+        # Weeks fetched again replace what was there before.
+        kept = existing[:, ~np.in1d(existing[WEEK_IDX], week_idxs)]
+        added = _columns_of(m.WeekData.objects.week_rows(user_id, week_idxs=week_idxs))
+        columns = np.hstack((kept, added))
+        order = np.argsort(columns[WEEK_IDX], kind='mergesort')
+        _write(user_id, columns[:, order])
+    return columns.shape[1]
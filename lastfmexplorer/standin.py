@@ -0,0 +1,94 @@
+"""
+A local HTTP server that pretends to be Last.fm's web service, serving the
+responses in test-data.  Lets the real HTTP code in requester.py be tested
+and benchmarked without touching the network.
+"""
+import os
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlsplit, parse_qsl
+
+from requester import test_data_path
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), 'test-data')
+
+_NOT_FOUND = '<?xml version="1.0" encoding="utf-8"?>\n<lfm status="failed"><error code="6">No such page</error></lfm>'
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+
+    # Keep-alive.
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connection_opened()
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        args = dict(parse_qsl(urlsplit(self.path).query))
+        try:
+            path = os.path.join(server.rootDataDir, test_data_path(args.pop('method', None), args))
+            with open(path) as f:
+                status, body = 200, f.read()
+        except (ValueError, KeyError, IOError):
+            status, body = 404, _NOT_FOUND
+
+        server.request_served()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves rootDataDir on a free local port from a background thread.
+    latency is seconds to wait before answering each request.  Counts the
+    connections opened and requests served.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, rootDataDir=TEST_DATA, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInHandler)
+        self.rootDataDir = rootDataDir
+        self.latency = latency
+        self.connections = 0
+        self.requests = 0
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    @property
+    def root(self):
+        """URL to give LastFMRequester."""
+        return "http://127.0.0.1:%d/2.0/" % (self.server_address[1],)
+
+    def connection_opened(self):
+        with self.__lock:
+            self.connections += 1
+
+    def request_served(self):
+        with self.__lock:
+            self.requests += 1
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.__thread.join()
@@ -0,0 +1,154 @@
+"""
+Everything on the overview page, computed from one query.
+
+The manager methods behind the overview each aggregate the same range of a
+user's WeekData rows.  OverviewSummary fetches (week_idx, artist, plays) for
+the range once and derives every statistic from those columns with NumPy,
+apart from the weekly totals, which come from the cached UserWeekTotal rollup
+that weekly_play_counts reads.
+"""
+import time
+
+import numpy as np
+
+import ldates
+import snapshot
+from models import Artist, WeekData
+
+
+class SummaryChart(list):
+    """
+    A list of (artist, plays) pairs with the max attribute the chart template
+    needs for bar widths.
+    """
+
+    def __init__(self, entries):
+        super(SummaryChart, self).__init__(entries)
+        self.max = entries[0][1] if entries else None
+
+
+class OverviewSummary(object):
+    """
+    Statistics for a user's overview between start and end.  Nothing is
+    fetched until the first statistic is asked for, and the user's snapshot is
+    read instead of WeekData when they have one.  Afterwards queries holds
+    the number of queries made for week data and artists, not counting the
+    weekly totals, which are usually cached, and timings the seconds spent
+    fetching and computing.
+    """
+
+    def __init__(self, user, start, end, chart_count=100, record_count=10, bins=10):
+        self.user = user
+        self.start = start
+        self.end = end
+        self.chart_count = chart_count
+        self.record_count = record_count
+        self.bins = bins
+        self.queries = 0
+        self.timings = {}
+        self.computed = False
+
+    def __getattr__(self, name):
+        # Statistics are plain attributes set by _compute.
+        if name.startswith('_') or self.computed:
+            raise AttributeError(name)
+        # Set first so a missing attribute inside _compute can't recurse,
+        # and cleared if it fails so the next access raises the real error.
+        self.computed = True
+        try:
+            self._compute()
+        except:
+            self.computed = False
+            raise
+        return getattr(self, name)
+
+    def _fetch(self):
+        began = time.time()
+        snap = snapshot.load(self.user.id)
+        if snap is not None:
+            rows = snap.between(self.start, self.end)
+            self.timings['fetch'] = time.time() - began
+            return (rows.week_idx.astype(np.int64) - self.start,
+                    rows.artist_id.astype(np.int64), rows.plays.astype(np.int64))
+
+        if WeekData.objects.packed():
+            rows = [row[:3] for row in WeekData.objects.week_rows(self.user.id, self.start, self.end)]
+        else:
+            rows = WeekData.objects.user_weeks_between(self.user, self.start, self.end) \
+                       .values_list('week_idx', 'artist', 'plays')
+        columns = np.array(list(rows), dtype=np.int64).reshape(-1, 3)
+        self.queries += 1
+        self.timings['fetch'] = time.time() - began
+        return columns[:, 0] - self.start, columns[:, 1], columns[:, 2]
+
+    def _compute(self):
+        weeks, artists, plays = self._fetch()
+
+        began = time.time()
+        totals = np.array(WeekData.objects.weekly_totals(self.user, self.start, self.end),
+                          dtype=np.int64).reshape(-1, 3)
+        self.timings['totals'] = time.time() - began
+
+        began = time.time()
+        span = self.end - self.start + 1
+        num = self.record_count
+
+        # Per week totals from the UserWeekTotal rollup, as weekly_play_counts
+        # has them.  Weeks after the last one with data aren't shown.
+        weekly = np.zeros(span, dtype=np.int64)
+        uniques = np.zeros(span, dtype=np.int64)
+        weekly[totals[:, 0] - self.start] = totals[:, 1]
+        uniques[totals[:, 0] - self.start] = totals[:, 2]
+        populated = np.flatnonzero(uniques)
+        shown = populated[-1] + 1 if len(populated) else 0
+        indices = np.arange(self.start, self.start + shown)
+
+        self.total_plays = int(weekly.sum())
+        self.wpcs = zip(indices.tolist(), weekly[:shown].tolist())
+
+        # Histogram of weekly counts.
+        counts = weekly[:shown]
+        step = (int(counts.max()) / self.bins) + 1 if shown else 1
+        self.wpc_hist = np.bincount(counts / step, minlength=self.bins).tolist()
+        self.wpc_hist_step = step
+
+        # Plays per calendar month.
+        months = ldates.months_of_indices(indices) - 1
+        self.mcjs = np.bincount(months, weights=counts, minlength=12).astype(np.int64).tolist()
+
+        # Record weeks by total plays and by unique artists, stable so ties
+        # come out in week order.
+        by_total = populated[np.argsort(-weekly[populated], kind='mergesort')][:num]
+        dates = ldates.dates_of_indices(self.start + by_total).tolist()
+        self.record_total_plays = [(self.start + i, d, int(weekly[i]))
+                                      for i, d in zip(by_total.tolist(), dates)]
+        by_uniques = populated[np.argsort(-uniques[populated], kind='mergesort')][:num]
+        dates = ldates.dates_of_indices(self.start + by_uniques).tolist()
+        self.record_unique_artists = [(self.start + i, d, int(uniques[i]))
+                                         for i, d in zip(by_uniques.tolist(), dates)]
+
+        # Most plays of one artist in a single week.
+        single = np.argsort(-plays, kind='mergesort')[:num]
+
+        # Total plays of each artist.
+        artist_ids, inverse = np.unique(artists, return_inverse=True)
+        per_artist = np.bincount(inverse, weights=plays).astype(np.int64)
+        top = np.argsort(-per_artist, kind='mergesort')[:self.chart_count]
+        self.timings['compute'] = time.time() - began
+
+        began = time.time()
+        wanted = set(artist_ids[top].tolist()) | set(artists[single].tolist())
+        loaded = Artist.objects.in_bulk(list(wanted)) if wanted else {}
+        self.queries += 1 if wanted else 0
+        self.timings['artists'] = time.time() - began
+
+        self.record_single_artist = []
+        for i in single.tolist():
+            week = WeekData(user=self.user, week_idx=self.start + int(weeks[i]),
+                            artist=loaded[int(artists[i])], plays=int(plays[i]))
+            self.record_single_artist.append((week, ldates.date_of_index(week.week_idx)))
+
+        self.chart = SummaryChart([(loaded[int(artist_ids[i])], int(per_artist[i])) for i in top.tolist()])
+
+    def __repr__(self):
+        return "<OverviewSummary:%s:%d:%d>" % (self.user, self.start, self.end)
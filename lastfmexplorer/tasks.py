@@ -3,18 +3,29 @@ Retrieve data from database and fetch it from last.fm when necessary.
 """
 import logging
 import lxml.etree as ET
-from datetime import date
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from celery.task.sets import TaskSet
 from celery.task import task
 
+from django.conf import settings
 from django.db import transaction
 from django.core.cache import cache
 
 from models import *
+import snapshot
+import usercache
+from requester import RateLimiter, register, requester_for_key
+from utils import LRUCache
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Artist name to id, shared by every task run in this worker process.  Popular
+# artists turn up in most users' charts so most lookups never reach the
+# database.
+ARTIST_IDS = LRUCache(maxsize=100000)
+
 ###############################################################################
 ########## Helpful XML functions ##############################################
 
@@ -33,6 +44,64 @@ def __elem(el, n):
     return el.find(n).text
 
 
+class _ChartRowTarget(object):
+    """
+    lxml parser target that collects one row per field element without
+    building a tree.  A row is the text of each of the named children (None
+    if missing or empty) followed by the field's rank attribute.
+    """
+
+    def __init__(self, field, children):
+        self.field = field
+        self.children = children
+        self.rows = []
+        self.__row = None
+        self.__text = None
+
+    def start(self, tag, attrib):
+        if tag == self.field:
+            self.__row = { 'rank' : attrib.get('rank') }
+        elif self.__row is not None and tag in self.children:
+            self.__text = []
+
+    def data(self, data):
+        if self.__text is not None:
+            self.__text.append(data)
+
+    def end(self, tag):
+        if self.__row is None:
+            return
+        if tag == self.field:
+            self.rows.append(tuple(self.__row.get(c) for c in self.children) + (self.__row['rank'],))
+            self.__row = None
+        elif self.__text is not None and tag in self.children:
+            self.__row[tag] = ''.join(self.__text) if self.__text else None
+            self.__text = None
+
+    def close(self):
+        pass
+
+
+def _iter_chart_rows(xml, field, children, chunk_size=16384):
+    """
+    Streams rows out of a weekly chart.  Yields a tuple for every field
+    element of the text of each of its children, then its rank.  Feeds
+    the parser chunk_size bytes at a time and never holds a tree, so
+    memory use doesn't grow with the size of the chart.  Recovers from
+    broken XML like __iter_over_field.
+    """
+    target = _ChartRowTarget(field, children)
+    parser = ET.XMLParser(target=target, encoding="utf-8", recover=True)
+    for offset in xrange(0, len(xml), chunk_size):
+        parser.feed(xml[offset:offset+chunk_size])
+        for row in target.rows:
+            yield row
+        del target.rows[:]
+    parser.close()
+    for row in target.rows:
+        yield row
+
+
 ###############################################################################
 ########## Exceptions #########################################################
 
@@ -128,19 +197,22 @@ def _parse_week_artist_data(xml):
 
     Returns dictionary with key artist id, value (plays, rank)
     """
+    rows = []
+    for artist, pc, rank in _iter_chart_rows(xml, 'artist', ('name', 'playcount')):
+        rows.append((artist[:MAX_ARTIST_NAME_LENGTH], int(pc), int(rank)))
+
+    artist_ids = Artist.objects.ids_of_names((artist for artist, _, _ in rows), ARTIST_IDS)
+
     data = {}
-    for d in __iter_over_field(xml, 'artist'):
-        artist = __elem(d, 'name')
-        pc     = int(__elem(d, 'playcount'))
-        rank   = int(__attr(d, 'rank'))
-        a, _ = Artist.objects.get_or_create(name=artist)
+    for artist, pc, rank in rows:
+        aid = artist_ids[artist]
 
         # Truncating this artist's name could cause a key clash
         # Add the playcount to that entry.
-        if a.id in data:
-            othercount, rank = data[a.id]
+        if aid in data:
+            othercount, rank = data[aid]
             pc += othercount
-        data[a.id] = (pc, rank)
+        data[aid] = (pc, rank)
 
     return data
 
@@ -155,132 +227,350 @@ def _parse_week_track_data(xml):
          <url>..</url>
        </track>
 
-    Returns dictionary with key artist id, value (plays, rank)
+    Returns dictionary with key track id, value (plays, rank)
     """
-    data = {}
-    for d in __iter_over_field(xml, 'track'):
-        artist = __elem(d, 'artist')
-        title  = __elem(d, 'name')
-        pc     = int(__elem(d, 'playcount'))
-        rank   = int(__attr(d, 'rank'))
+    max_title = Track._meta.get_field('title').max_length
+    rows = []
+    for artist, title, pc, rank in _iter_chart_rows(xml, 'track', ('artist', 'name', 'playcount')):
+        rows.append((artist[:MAX_ARTIST_NAME_LENGTH], title[:max_title], int(pc), int(rank)))
+
+    artist_ids = Artist.objects.ids_of_names((artist for artist, _, _, _ in rows), ARTIST_IDS)
+    track_ids  = Track.objects.ids_of_tracks((artist_ids[artist], title) for artist, title, _, _ in rows)
 
-        a, _ = Artist.objects.get_or_create(name=artist)
-        t, _ = Track.objects.get_or_create(title=title, artist=a)
+    data = {}
+    for artist, title, pc, rank in rows:
+        tid = track_ids[(artist_ids[artist], title)]
 
         # Truncating this artist's name could cause a key clash
         # Add the playcount to that entry.
-        if t.id in data:
-            othercount, rank = data[t.id]
+        if tid in data:
+            othercount, rank = data[tid]
             pc += othercount
-        data[t.id] = (pc, rank)
+        data[tid] = (pc, rank)
 
     return data
 
 
 @transaction.commit_manually
-def __save_week_artist_data(user_id, week_idx, wd):
+def __save_weeks(model, user_id, weeks):
+    """
+    Writes weeks, a dictionary of week index to parsed data, to model in one
+    transaction.  Raises GetWeekFailed if anything goes wrong.
+    """
     try:
-        for artistid, (plays, rank) in wd.iteritems():
-            WeekData.objects.create(user_id=user_id, artist_id=artistid, week_idx=week_idx, plays=plays, rank=rank)
+        model.objects.insert_weeks(user_id, weeks)
+        if model is WeekData:
+            UserWeekTotal.objects.record(user_id, weeks)
         transaction.commit()
     except Exception, e:
         transaction.rollback()
-        logging.error("__save_week_artist_data failed with %s. user: %d, week: %d, message: %s" % (str(type(e)), user_id, week_idx, e.message))
+        logging.error("__save_weeks failed with %s. model: %s, user: %d, weeks: %s, message: %s" % \
+                (str(type(e)), model.__name__, user_id, sorted(weeks.keys()), e.message))
         raise GetWeekFailed(e.message)
-        # logging.error(__url_for_request("user.getweeklyartistchart", {'user':user, 'from':start, 'to':end}))
 
-@transaction.commit_manually
+def __save_week_artist_data(user_id, week_idx, wd):
+    __save_weeks(WeekData, user_id, {week_idx: wd})
+
 def __save_week_track_data(user_id, week_idx, wd):
+    __save_weeks(WeekTrackData, user_id, {week_idx: wd})
+
+
+# Update type => (chart kind, parser, model saved to)
+_CHARTS = {
+    Update.ARTIST : ('artist', _parse_week_artist_data, WeekData),
+    Update.TRACK  : ('track', _parse_week_track_data, WeekTrackData),
+}
+
+def __parse_week(user_id, username, start, end, fetch, parser):
+    """
+    Parses the week fetch() returns the XML of.  Returns the parsed data, or
+    None if the week couldn't be fetched or parsed.  Weeks that aren't valid
+    XML are recorded in WeeksWithSyntaxErrors.
+    """
+    xml = None
     try:
-        for trackid, (plays, rank) in wd.iteritems():
-            WeekTrackData.objects.create(user_id=user_id, track_id=trackid, week_idx=week_idx, plays=plays, rank=rank)
-        transaction.commit()
+        xml = fetch()
+        return parser(xml)
+    except GetWeekFailed:
+        pass
+    except SyntaxError:
+        logging.error("request for %s/%d/%d caused a syntax error." % (username, start, end))
+        logging.error(xml)
+        WeeksWithSyntaxErrors.objects.create(user_id=user_id, week_idx=ldates.index_of_timestamp(end))
     except Exception, e:
-        transaction.rollback()
-        logging.error("__save_week_track_data failed with %s. user: %d, week: %d, message: %s" % (str(type(e)), user_id, week_idx, e.message))
-        raise GetWeekFailed(e.message)
+        logging.error("request for %s/%d/%d caused an unknown error: %s" % (username, start, end, e.message))
+        logging.error(xml)
+    return None
+
+def _weeks_saved(user_id, type, week_idxs, populated):
+    """
+    Called once weeks of a user's data have been saved, to bring anything
+    derived from them up to date.  populated are the weeks in week_idxs with
+    any rows.
+    """
+    if type == Update.ARTIST:
+        User.objects.record_saved_weeks(user_id, week_idxs, populated)
+
+def _snapshot_saved(user_id, week_idxs):
+    """
+    Called once a chunk of a user's artist weeks is saved and its updates
+    finished.  Rewriting the snapshot for every chunk of a backfill would
+    write it weeks / chunk times over, so while other weeks are still in
+    progress it's discarded instead, and whichever chunk finishes last brings
+    it up to date.  A chunk that finds the snapshot still there knows every
+    other chunk either finished before it was last written or will discard
+    it, so only week_idxs have to be read.
+    """
+    if not snapshot.enabled():
+        return
+    try:
+        if Update.objects.is_updating(user_id):
+            snapshot.discard(user_id)
+        else:
+            snapshot.update(user_id, week_idxs)
+    except Exception as e:
+        # The snapshot is rebuilt in full next time the user's weeks are saved.
+        logging.error("Failed to update snapshot for user %d: %s" % (user_id, e))
+        snapshot.discard(user_id)
+
+def __parse_and_save(user_id, username, fetched, type):
+    """
+    Parses and saves fetched, a list of (start, end, fetch) where fetch()
+    returns the week's XML, and marks their updates COMPLETE or ERRORED.
+    Every week parsed is saved in one bulk insert, falling back to a week at
+    a time if that fails so one bad week doesn't take the rest with it.
+    Returns (set of complete week indexes, set of errored week indexes).
+    """
+    _, parser, model = _CHARTS[type]
+
+    parsed = {}
+    for start, end, fetch in fetched:
+        wd = __parse_week(user_id, username, start, end, fetch, parser)
+        if wd is not None:
+            parsed[ldates.index_of_timestamp(end)] = wd
+    logging.debug("artist id cache: %(size)d entries, %(hits)d hits, %(misses)d misses" % ARTIST_IDS.stats())
+
+    complete = set()
+    if parsed:
+        try:
+            __save_weeks(model, user_id, parsed)
+            complete.update(parsed)
+        except GetWeekFailed:
+            if len(parsed) > 1:
+                for week_idx, wd in parsed.iteritems():
+                    try:
+                        __save_weeks(model, user_id, {week_idx: wd})
+                        complete.add(week_idx)
+                    except GetWeekFailed:
+                        pass
+
+    errored = set(ldates.indices_of_timestamps([end for _, end, _ in fetched]).tolist()).difference(complete)
+    if complete:
+        _weeks_saved(user_id, type, complete, set(w for w in complete if parsed[w]))
+    Update.objects.finish(user_id, type, complete, errored)
+    if complete:
+        if type == Update.ARTIST:
+            _snapshot_saved(user_id, complete)
+        # Only now: pages rendered from the old snapshot would otherwise be
+        # cached under the new version.
+        usercache.bump_version(user_id)
+    return complete, errored
+
+def __fetch_weeks(user_id, username, requester, weeks, type):
+    """
+    Fetches, parses and saves weeks, a list of (start, end) timestamps, one
+    after another.  See __parse_and_save.
+    """
+    kind = _CHARTS[type][0]
+    logging.debug("fetch_weeks called: %s, %s, %d weeks" % (username, kind, len(weeks)))
+    fetched = [(start, end, partial(week_data, username, requester, start, end, kind))
+                  for start, end in weeks]
+    return __parse_and_save(user_id, username, fetched, type)
 
 
 @task(ignore_result=True)
-def fetch_week_data(user, requester, start, end, type):
-    """Args: user, instance of Requestor, week start and end timestamps, kind."""
+def fetch_week_data(user_id, username, requester_key, start, end, type):
+    """
+    Args: user id and name, key of a Requester, week start and end
+    timestamps, kind.  Only primitives so task messages stay small.
+    """
+    if type not in _CHARTS:
+        return
+    requester = requester_for_key(requester_key)
+    complete, _ = __fetch_weeks(user_id, username, requester, [(start, end)], type)
+    return Update.COMPLETE if complete else Update.ERRORED
 
-    week_idx = ldates.index_of_timestamp(end)
-    u = Update.objects.get(user=user, week_idx=week_idx, status=Update.IN_PROGRESS, type=type)
 
-    if type == Update.ARTIST:
-        kind = 'artist'
-        parser = _parse_week_artist_data
-        saver  = __save_week_artist_data
-    elif type == Update.TRACK:
-        kind = 'track'
-        parser = _parse_week_track_data
-        saver  = __save_week_track_data
-    else:
+@task(ignore_result=True)
+def fetch_weeks_data(user_id, username, requester_key, weeks, type):
+    """
+    Args: user id and name, key of a Requester, list of (start, end) week
+    timestamps, kind.  Like fetch_week_data for many weeks at once.
+    """
+    if type not in _CHARTS:
         return
-        #kind = 'album'
-        #parser = __parse_week_track_data
-        #saver  = __save_week_track_data
+    requester = requester_for_key(requester_key)
+    __fetch_weeks(user_id, username, requester, weeks, type)
+
 
-    logging.debug("fetch_week called: %s, %s, %d %d" % (user.username, kind, start, end))
+###############################################################################
+########## Fetching many weeks at once ########################################
+
+def __already_fetched(xml, error):
+    if error is not None:
+        raise error
+    return xml
+
+def _fetch_concurrently(username, requester, weeks, kind, workers, rate):
+    """
+    Requests weeks, a list of (start, end) timestamps, from workers threads
+    at once, starting no more than rate requests a second between them.
+    Yields (start, end, fetch) in the order responses arrive, where fetch()
+    returns the week's XML or raises whatever fetching it raised.
+    """
+    limiter = RateLimiter(rate)
+
+    def fetch((start, end)):
+        limiter.wait()
+        try:
+            return start, end, week_data(username, requester, start, end, kind), None
+        except Exception, e:
+            return start, end, None, e
 
+    pool = ThreadPool(workers)
     try:
-        xml = week_data(user, requester, start, end, kind)
-        wd = parser(xml)
-        saver(user.id, week_idx, wd)
-        u.status = Update.COMPLETE
-    except GetWeekFailed:
-        u.status = Update.ERRORED
-    except SyntaxError:
-        logging.error("request for %s/%d/%d caused a syntax error." % (user, start, end))
-        logging.error(xml)
-        WeeksWithSyntaxErrors.objects.create(user_id=user.id, week_idx=week_idx)
-        u.status = Update.ERRORED
-    except Exception, e:
-        logging.error("request for %s/%d/%d caused an unknown error: %s" % (user, start, end, e.message))
-        logging.error(xml)
-        u.status = Update.ERRORED
+        for start, end, xml, error in pool.imap_unordered(fetch, weeks):
+            yield start, end, partial(__already_fetched, xml, error)
     finally:
-        u.save()
+        pool.terminate()
+
+def fetch_weeks_concurrently(user_id, username, requester, weeks, type,
+        workers=None, rate=None, weeks_per_save=None):
+    """
+    Like fetch_weeks_data, but fetching from Last.fm with many threads.
+    Responses are parsed and saved weeks_per_save at a time in this thread
+    as they arrive.  workers, rate (requests per second) and weeks_per_save
+    default to settings LASTFM_FETCH_WORKERS, LASTFM_REQUESTS_PER_SECOND and
+    LASTFM_WEEKS_PER_TASK.  Returns (set of complete week indexes, set of
+    errored week indexes).
+    """
+    kind = _CHARTS[type][0]
+    workers = workers or getattr(settings, 'LASTFM_FETCH_WORKERS', 8)
+    rate = rate or getattr(settings, 'LASTFM_REQUESTS_PER_SECOND', 5)
+    weeks_per_save = weeks_per_save or getattr(settings, 'LASTFM_WEEKS_PER_TASK', 10)
+
+    complete, errored = set(), set()
+    def save(chunk):
+        c, e = __parse_and_save(user_id, username, chunk, type)
+        complete.update(c)
+        errored.update(e)
+
+    chunk = []
+    for fetched in _fetch_concurrently(username, requester, weeks, kind, workers, rate):
+        chunk.append(fetched)
+        if len(chunk) == weeks_per_save:
+            save(chunk)
+            chunk = []
+    if chunk:
+        save(chunk)
+
+    return complete, errored
+
+
+@task(ignore_result=True)
+def backfill_weeks(user_id, username, requester_key, weeks, type, workers=None, rate=None):
+    """fetch_weeks_concurrently as a celery task."""
+    if type not in _CHARTS:
+        return
+    requester = requester_for_key(requester_key)
+    fetch_weeks_concurrently(user_id, username, requester, weeks, type, workers, rate)
 
-    return u.status
 
+###############################################################################
+########## Updating users #####################################################
 
-def update_user(user, requester):
-    """ Fetch new weeks, or possibly those that failed before."""
+def _weeks_to_plan(user, chart_list):
+    """
+    Returns the (start, end) timestamps from chart_list, which is in date
+    order, that need fetching: every week after the last one fetched, the
+    high-water mark, and the gaps before it that were never fetched or
+    errored.  Both come from bit operations on user.weeks_fetched, and
+    chart_list is only walked back from its end unless there are gaps.
+    """
+    first = user.first_sunday_with_data
+    fetched = user.weeks_fetched
+    high_water = fetched.last()
+    if high_water is None or high_water < first:
+        high_water = first - 1
+    gaps = fetched.missing_between(first, high_water)
+
+    weeks = []
+    for start, end in reversed(chart_list):
+        idx = ldates.index_of_timestamp(end)
+        if idx > high_water:
+            weeks.append((start, end))
+        elif not gaps:
+            break
+        elif idx in gaps:
+            weeks.append((start, end))
+    weeks.reverse()
+    return weeks
+
+def plan_update(user, requester):
+    """
+    Creates IN_PROGRESS updates for every week of user's data to fetch and
+    returns their (start, end) timestamps.
+    """
     # TODO: fail here if couldn't contact last.fm
     # Have to fetch the chart list from last.fm because their timestamps are awkward, especially
     # those on the first few charts released.
-    chart_list = fetch_chart_list(user.username, requester)
-    successful_requests = Update.objects.weeks_fetched(user)
+    chart_list = list(fetch_chart_list(user.username, requester))
+    weeks = _weeks_to_plan(user, chart_list)
+    idxs = ldates.indices_of_timestamps([end for _, end in weeks]).tolist()
+    Update.objects.bulk_create([Update(user=user, week_idx=idx, type=Update.ARTIST) for idx in idxs])
+    return weeks
+
+def update_user(user, requester, weeks_per_task=None):
+    """
+    Fetch new weeks, or possibly those that failed before.  Queues one task
+    per weeks_per_task weeks, defaulting to settings.LASTFM_WEEKS_PER_TASK.
+    """
+    weeks_per_task = weeks_per_task or getattr(settings, 'LASTFM_WEEKS_PER_TASK', 10)
+    weeks = plan_update(user, requester)
 
     # create taskset and run it.
-    update_tasks = []
-    updates = []
-    with transaction.commit_on_success():
-        for start, end in chart_list:
-            idx = ldates.index_of_timestamp(end)
-            # Skip if this week is before the user signed up
-            if not idx < user.first_sunday_with_data:
-                # skip if data has already been successfully fetched
-                if (idx, Update.ARTIST) not in successful_requests:
-                    update = Update(user=user, week_idx=idx, type=Update.ARTIST)
-                    updates.append(update)
-                    update_tasks.append(fetch_week_data.subtask((user, requester, start, end, Update.ARTIST)))
-#                if (idx, Update.TRACK) not in successful_requests:
-#                    Update.objects.create(user=user, week_idx=idx, type=Update.TRACK)
-#                    update_tasks.append(fetch_week_data.subtask((user, requester, start, end, Update.TRACK)))
-
-    Update.objects.bulk_create(updates)
+    key = register(requester)
+    update_tasks = [fetch_weeks_data.subtask((user.id, user.username, key, weeks[i:i+weeks_per_task], Update.ARTIST))
+                        for i in xrange(0, len(weeks), weeks_per_task)]
     ts = TaskSet(update_tasks)
     ts.apply_async()
 
-    user.last_updated = date.today()
-    user.save()
+    # Only last_updated: the week sets were saved by the fetch since user was loaded.
+    user.last_updated = ldates.today()
+    user.save(update_fields=['last_updated'])
 
     return len(update_tasks) > 0
 
 
+def backfill_user(user, requester, workers=None, rate=None, queue=False):
+    """
+    Like update_user, but fetches every week with fetch_weeks_concurrently,
+    either here or, if queue is set, in a single backfill_weeks task.
+    """
+    weeks = plan_update(user, requester)
+    if weeks:
+        if queue:
+            backfill_weeks.delay(user.id, user.username, register(requester), weeks, Update.ARTIST, workers, rate)
+        else:
+            fetch_weeks_concurrently(user.id, user.username, requester, weeks, Update.ARTIST, workers, rate)
+
+    # Only last_updated: the week sets were saved by the fetch since user was loaded.
+    user.last_updated = ldates.today()
+    user.save(update_fields=['last_updated'])
+
+    return len(weeks) > 0
+
+
 ###############################################################################
 ########## Retrieving tags for an artist ######################################
 
@@ -1,14 +1,29 @@
 import os
+import shutil
+import tempfile
+import time
+import numpy
 
 from datetime import date
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 
 import tasks
 import requester
 import ldates
+import standin
 import chart
+import snapshot
+import summary
+import usercache
+import utils
+import views
+from management.commands import bench_plan_update
 
-from models import Artist, Update, User, WeekData
+from models import Artist, PackedWeekData, Track, Update, User, UserWeekTotal, WeekData, MAX_ARTIST_NAME_LENGTH
 
 
 def makeUser(name, registered=date(2004, 2, 2), last_updated=date.today(), image="http://www.example.com"):
@@ -27,6 +42,19 @@ class UserTests(TransactionTestCase):
         for name in names:
             self.assertFalse(User.valid_username(name), "Expected invalid name on: '"+name+"'")
 
+    def testWeeksWithData(self):
+        user = makeUser("test-weeks")
+        self.assertEqual(None, user.first_available_week)
+        User.objects.record_saved_weeks(user.id, [3, 5, 9], [3, 9])
+        User.objects.record_saved_weeks(user.id, [9], [])
+        user = User.objects.get(id=user.id)
+        self.assertEqual([3], list(user.weeks_with_data))
+        self.assertEqual([3, 5, 9], list(user.weeks_fetched))
+        self.assertEqual([0, 1, 2, 4], list(user.weeks_fetched.missing_between(-1, 5)))
+        self.assertEqual((3, 3), (user.first_available_week, user.last_available_week))
+        self.assertTrue(user.weeks_with_data.any_between(0, 3))
+        self.assertFalse(user.weeks_with_data.any_between(4, 10))
+
 
 class XMLHandling(TestCase):
     """Tests for valid and troublesome Last.fm XML files"""
@@ -38,6 +66,7 @@ class XMLHandling(TestCase):
     def tearDown(self):
         Artist.objects.all().delete()
         WeekData.objects.all().delete()
+        tasks.ARTIST_IDS.clear()
 
     def testWeeklyChartParsing(self):
         chartList = list(tasks.fetch_chart_list('aradnuk', self.requester))
@@ -65,6 +94,207 @@ class XMLHandling(TestCase):
         playcount, artistId = data[data.keys()[0]]
         self.assertEqual(playcount, 1)
 
+    def testFetchWeeksData(self):
+        user = makeUser("aradnuk")
+        weeks = list(tasks.fetch_chart_list('aradnuk', self.requester))
+        for _, end in weeks:
+            Update.objects.create(user=user, week_idx=ldates.index_of_timestamp(end), type=Update.ARTIST)
+
+        tasks.fetch_weeks_data(user.id, user.username, requester.register(self.requester), weeks, Update.ARTIST)
+        self.assertFalse(Update.objects.is_updating(user))
+        self.assertEqual(len(Update.objects.weeks_fetched(user)), len(weeks))
+        self.assertEqual(WeekData.objects.filter(user=user, week_idx=2).count(), 74)
+        self.assertEqual(UserWeekTotal.objects.get(user=user, week_idx=2).unique_artists, 74)
+        self.assertTrue(2 in User.objects.get(id=user.id).weeks_with_data)
+        self.assertEqual(len(User.objects.get(id=user.id).weeks_fetched), len(weeks))
+
+    def testBackfillKeepsWeekSets(self):
+        user = makeUser("aradnuk", last_updated=date(2012, 1, 1))
+        self.assertTrue(tasks.backfill_user(user, self.requester, workers=2, rate=100))
+        user = User.objects.get(id=user.id)
+        self.assertEqual(4, len(user.weeks_fetched))
+        self.assertTrue(2 in user.weeks_with_data)
+        self.assertEqual(0, user.first_available_week)
+        self.assertEqual(ldates.today(), user.last_updated)
+        # Nothing left to fetch.
+        self.assertFalse(tasks.backfill_user(user, self.requester, workers=2, rate=100))
+
+
+class ArtistResolution(TestCase):
+    """Tests for resolving many artist names to ids at once"""
+    def testExistingAndNew(self):
+        existing = Artist.objects.create(name="BT")
+        ids = Artist.objects.ids_of_names(["BT", "Fleet Foxes", "Fleet Foxes"])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(ids["BT"], existing.id)
+        self.assertEqual(Artist.objects.get(id=ids["Fleet Foxes"]).name, "Fleet Foxes")
+
+    def testTruncation(self):
+        name = "x" * (MAX_ARTIST_NAME_LENGTH + 10)
+        ids = Artist.objects.ids_of_names([name, name[:MAX_ARTIST_NAME_LENGTH]])
+        self.assertEqual(ids.keys(), [name[:MAX_ARTIST_NAME_LENGTH]])
+
+    def testIdCache(self):
+        id_cache = utils.LRUCache(maxsize=2)
+        first = Artist.objects.ids_of_names(["a", "b"], id_cache)
+        self.assertEqual(id_cache.misses, 2)
+        again = Artist.objects.ids_of_names(["a", "b"], id_cache)
+        self.assertEqual(first, again)
+        self.assertEqual(id_cache.hits, 2)
+
+        # c evicts a, the least recently used.
+        Artist.objects.ids_of_names(["c"], id_cache)
+        self.assertEqual(sorted(id_cache.get_many(["a", "b", "c"])), ["b", "c"])
+
+    def testLostRace(self):
+        # Another worker creates one of the names first, failing our insert.
+        def racing_bulk_create(objs, **kwargs):
+            Artist(name="Fleet Foxes").save()
+            raise IntegrityError("duplicate key value violates unique constraint")
+        Artist.objects.bulk_create = racing_bulk_create
+        try:
+            ids = Artist.objects.ids_of_names(["Fleet Foxes", "Grizzly Bear"], utils.LRUCache(maxsize=10))
+        finally:
+            del Artist.objects.bulk_create
+        self.assertEqual(sorted(ids), ["Fleet Foxes", "Grizzly Bear"])
+        self.assertEqual(ids["Grizzly Bear"], Artist.objects.get(name="Grizzly Bear").id)
+
+    def testLostRaceForTracks(self):
+        artist = Artist.objects.create(name="BT")
+        def racing_bulk_create(objs, **kwargs):
+            Track(artist=artist, title="Dreaming").save()
+            raise IntegrityError("duplicate key value violates unique constraint")
+        Track.objects.bulk_create = racing_bulk_create
+        try:
+            ids = Track.objects.ids_of_tracks([(artist.id, "Dreaming"), (artist.id, "Flaming June")])
+        finally:
+            del Track.objects.bulk_create
+        self.assertEqual(ids[(artist.id, "Flaming June")], Track.objects.get(title="Flaming June").id)
+        self.assertEqual(2, len(ids))
+
+
+class WeekDataInsertion(TransactionTestCase):
+    def setUp(self):
+        self.user = makeUser("test-inserts")
+        self.a = Artist.objects.create(name='a')
+        self.b = Artist.objects.create(name='b')
+
+    def testStrategiesAgree(self):
+        weeks = { 3: { self.a.id: (5, 1), self.b.id: (2, 2) },
+                  4: { self.b.id: (1, 1) } }
+        written = []
+        for strategy in (WeekData.objects.INSERT_ROWS, WeekData.objects.INSERT_BULK):
+            self.assertEqual(3, WeekData.objects.insert_weeks(self.user.id, weeks, strategy))
+            written.append(sorted(WeekData.objects.filter(user=self.user)
+                                    .values_list('week_idx', 'artist', 'plays', 'rank')))
+            WeekData.objects.filter(user=self.user).delete()
+        self.assertEqual(written[0], written[1])
+        self.assertEqual(written[0], [(3, self.a.id, 5, 1), (3, self.b.id, 2, 2), (4, self.b.id, 1, 1)])
+
+
+class RequesterKeys(TestCase):
+    def testRebuiltFromKey(self):
+        self.assertTrue(isinstance(requester.requester_for_key('lastfm'), requester.LastFMRequester))
+        built = requester.requester_for_key('test:/tmp/lex-test-data')
+        self.assertEqual(built.rootDataDir, '/tmp/lex-test-data')
+        self.assertTrue(built is requester.requester_for_key(built.key))
+        self.assertRaises(ValueError, requester.requester_for_key, 'carrier-pigeon')
+
+
+class PooledRequests(TestCase):
+    """Requests over HTTP to a stand-in for Last.fm"""
+    def setUp(self):
+        self.server = standin.StandInServer().start()
+        self.requester = requester.LastFMRequester(self.server.root)
+
+    def tearDown(self):
+        requester.connection_pool().clear()
+        self.server.stop()
+        tasks.ARTIST_IDS.clear()
+
+    def testKeepAlive(self):
+        chartList = list(tasks.fetch_chart_list('aradnuk', self.requester))
+        self.assertEqual(len(chartList), 4)
+        for start, end in chartList:
+            self.assertTrue(tasks.week_data('aradnuk', self.requester, start, end))
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def testFetchWeeksConcurrently(self):
+        user = makeUser("aradnuk")
+        weeks = tasks.plan_update(user, self.requester)
+        self.assertEqual(len(weeks), 4)
+
+        complete, errored = tasks.fetch_weeks_concurrently(user.id, user.username, self.requester,
+                weeks, Update.ARTIST, workers=4, rate=100, weeks_per_save=3)
+        self.assertEqual(len(complete), 4)
+        self.assertFalse(errored)
+        self.assertFalse(Update.objects.is_updating(user))
+        self.assertEqual(WeekData.objects.filter(user=user, week_idx=2).count(), 74)
+
+    def testMissingWeek(self):
+        response = self.requester.make('user.getweeklyartistchart', {'user':'aradnuk', 'from':1, 'to':2})
+        self.assertFalse(response['success'])
+        self.assertEqual(response['error']['code'], 404)
+
+
+class ResponseCache(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.inner = requester.TestRequester(os.path.join(os.path.dirname(__file__), "test-data"))
+        self.requester = requester.CachingRequester(self.inner, self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testPastWeeksServedFromDisk(self):
+        args = {'user': 'aradnuk', 'from': 1109505601, 'to': 1110110401}
+        fetched = self.requester.make('user.getweeklyartistchart', args)
+        self.inner.rootDataDir = "/nonexistent"
+        cached = self.requester.make('user.getweeklyartistchart', args)
+        self.assertTrue(cached['success'])
+        self.assertEqual(fetched['data'], cached['data'])
+        self.assertEqual((self.requester.hits, self.requester.misses), (1, 1))
+
+    def testChartListNotCached(self):
+        self.assertEqual(self.requester.path_for('user.getweeklychartlist', {'user': 'aradnuk'}), None)
+
+    def testOffline(self):
+        offline = requester.CachingRequester(self.inner, self.root, offline=True)
+        args = {'user': 'aradnuk', 'from': 1109505601, 'to': 1110110401}
+        self.assertFalse(offline.make('user.getweeklyartistchart', args)['success'])
+
+    def testStoreFailureNotRaised(self):
+        # A file where the store should be, so nothing can be written.
+        blocked = os.path.join(self.root, "blocked")
+        open(blocked, 'w').close()
+        broken = requester.CachingRequester(self.inner, blocked)
+        args = {'user': 'aradnuk', 'from': 1109505601, 'to': 1110110401}
+        self.assertTrue(broken.make('user.getweeklyartistchart', args)['success'])
+        self.assertEqual(os.listdir(self.root), ["blocked"])
+
+
+class RateLimiting(TestCase):
+    def testTokenBucket(self):
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        now = [100.25]
+        bucket = requester.TokenBucket('test-bucket', 2, cache=cache, clock=lambda: now[0])
+        self.assertEqual([bucket.try_take() for _ in xrange(3)], [0, 0, 0.75])
+        # Refilled the next second.
+        now[0] = 101.0
+        self.assertEqual(bucket.try_take(), 0)
+
+    def testBackoff(self):
+        for attempt in xrange(1, 10):
+            self.assertTrue(0 <= requester.backoff_delay(attempt) <= min(60, 2 ** (attempt - 1)))
+        self.assertEqual(requester.backoff_delay(1, retry_after=30), 30)
+        self.assertEqual(requester.backoff_delay(1, retry_after=3600), 60)
+
+    def testRetryAfter(self):
+        self.assertEqual(requester.retry_after({'retry-after': '120'}), 120)
+        self.assertEqual(requester.retry_after({}), None)
+        self.assertEqual(requester.retry_after({'retry-after': 'Thu, 01 Jan 1970 00:00:00 GMT'}), 0)
+
 
 class WeeklyTrackDataHandling(TestCase):
     pass
@@ -96,6 +326,37 @@ class Updates(TransactionTestCase):
     def testStalled(self):
         self.assertEqual(len(Update.objects.stalled()), 0)
 
+    def testFinish(self):
+        Update.objects.finish(self.testUserA, Update.ARTIST, set([1]), set([2]))
+        self.assertEqual(Update.objects.get(user=self.testUserA, week_idx=1).status, Update.COMPLETE)
+        self.assertEqual(Update.objects.get(user=self.testUserA, week_idx=2).status, Update.ERRORED)
+        self.assertEqual(Update.objects.get(user=self.testUserC, week_idx=1).status, Update.IN_PROGRESS)
+
+    def testWeeksToPlan(self):
+        # Registered in week 2.  Week 4 was never fetched, week 7 errored and
+        # weeks 9 to 11 are new.
+        user = makeUser("planned", registered=date(2005, 3, 1))
+        charts = bench_plan_update.chart_list(12)
+        fetched = [2, 3, 5, 6, 8]
+        User.objects.record_saved_weeks(user.id, fetched, fetched)
+        Update.objects.bulk_create(
+            [Update(user=user, week_idx=idx, type=Update.ARTIST, status=Update.COMPLETE) for idx in fetched] +
+            [Update(user=user, week_idx=7, type=Update.ARTIST, status=Update.ERRORED)])
+        user = User.objects.get(id=user.id)
+
+        planned = tasks._weeks_to_plan(user, charts)
+        self.assertEqual([4, 7, 9, 10, 11], [ldates.index_of_timestamp(end) for _, end in planned])
+        self.assertEqual(bench_plan_update.plan_from_updates(user, charts), planned)
+
+    def testWeeksToPlanStopsAtHighWater(self):
+        user = makeUser("planned", registered=date(2005, 3, 1))
+        User.objects.record_saved_weeks(user.id, range(2, 9), range(2, 9))
+        user = User.objects.get(id=user.id)
+        # Not a Sunday, so reading it would raise: nothing below week 9 is looked at.
+        charts = [(0, 1)] + bench_plan_update.chart_list(12)[1:]
+        planned = tasks._weeks_to_plan(user, charts)
+        self.assertEqual([9, 10, 11], [ldates.index_of_timestamp(end) for _, end in planned])
+
 
 class Dates(TestCase):
     def testSundaysBetween(self):
@@ -109,7 +370,7 @@ class Dates(TestCase):
         self.assertEqual(ldates.sundays_between(d(2012, 3, 13), d(2012, 3, 16)), [])
 
         # From the beginning of time..
-        self.assertEquals(ldates.sundays_between(d(2005, 2, 20), d.today()), range(0, ldates.idx_last_sunday+1))
+        self.assertEquals(ldates.sundays_between(d(2005, 2, 20), d.today()), range(0, ldates.index_of_last_sunday()+1))
 
     def testAllSundaysFallingIn(self):
         years = ldates.years_to_today()
@@ -120,6 +381,43 @@ class Dates(TestCase):
         expected = range(0, ldates.first_sunday_on_or_after(date(years[-1]+1, 1, 1)))
         self.assertEqual(indices, expected)
 
+    def testClock(self):
+        now = [date(2013, 3, 2)]
+        ldates.set_clock(lambda: now[0])
+        try:
+            saturday = ldates.fsoob(date(2013, 3, 2))
+            self.assertEqual(date(2013, 3, 2), ldates.today())
+            self.assertEqual(saturday, ldates.index_of_last_sunday())
+            # Sunday starts a new week, even for a process started before it.
+            now[0] = date(2013, 3, 3)
+            self.assertEqual(saturday + 1, ldates.index_of_last_sunday())
+            self.assertEqual(saturday + 1 - 4, ldates.months_ago(1))
+            now[0] = date(2004, 1, 1)
+            self.assertEqual(0, ldates.index_of_last_sunday())
+        finally:
+            ldates.set_clock()
+        self.assertEqual(ldates.fsoob(date.today()), ldates.index_of_last_sunday())
+
+    def testArraysOfWeeks(self):
+        idxs = range(0, ldates.index_of_last_sunday() + 60)
+        self.assertEqual([ldates.date_of_index(i) for i in idxs], ldates.dates_of_indices(idxs).tolist())
+        self.assertEqual([ldates.date_of_index(i).month for i in idxs], ldates.months_of_indices(idxs).tolist())
+        self.assertEqual([ldates.date_of_index(i).year for i in idxs], ldates.years_of_indices(idxs).tolist())
+        self.assertEqual([ldates.timestamp_of_index(i) for i in idxs], ldates.timestamps_of_indices(idxs).tolist())
+        years = range(2000, date.today().year + 5)
+        self.assertEqual([ldates.indicies_of_year(y)[0] for y in years], ldates.year_starts(years).tolist())
+        self.assertRaises(ValueError, ldates.dates_of_indices, [3, -1])
+
+        # Midnight, noon and late evening of Sundays, local time, and a
+        # few from before the beginning.
+        midnights = [time.mktime(ldates.date_of_index(i).timetuple()) for i in idxs] + \
+                    [time.mktime(date(2005, 1, 2).timetuple())]
+        timestamps = [t + offset for t in midnights for offset in (0, 12 * 60 * 60, 22 * 60 * 60)]
+        self.assertEqual([ldates.index_of_timestamp(t) for t in timestamps],
+                         ldates.indices_of_timestamps(timestamps).tolist())
+        self.assertRaises(ValueError, ldates.indices_of_timestamps, [timestamps[0], timestamps[0] - 1])
+        self.assertEqual([], ldates.indices_of_timestamps([]).tolist())
+
 
 class ChartTests(TransactionTestCase):
     def setUp(self):
@@ -156,6 +454,7 @@ class ChartTests(TransactionTestCase):
 
     def testCount(self):
         self.assertSequenceEqual([], chart.Chart(self.user, 0, 10, count=0))
+        self.assertSequenceEqual([], chart.Chart(self.user, 0, 10, count=-1))
         self.assertSequenceEqual([(self.c, 15)], chart.Chart(self.user, 0, 10, count=1))
         self.assertSequenceEqual([(self.c, 15), (self.a, 5)], chart.Chart(self.user, 0, 10, count=2))
 
@@ -173,6 +472,92 @@ class ChartTests(TransactionTestCase):
         pass
 
 
+class BlockTotalsTests(TestCase):
+    def setUp(self):
+        # week_idx, artist_id, plays, rank
+        rows = [(0, 1, 5, 1), (1, 1, 2, 1), (1, 2, 3, 2), (2, 2, 4, 1), (4, 3, 1, 1), (5, 1, 6, 1)]
+        self.totals = snapshot.BlockTotals.of_snapshot(snapshot.Snapshot(numpy.array(rows).T), block_weeks=2)
+
+    def testBetween(self):
+        self.assertEquals([1, 2, 3], self.totals.artist_ids.tolist())
+        self.assertEquals([13, 7, 1], self.totals.between(0, 5).tolist())
+        self.assertEquals([2, 7, 1], self.totals.between(1, 4).tolist())
+        self.assertEquals([0, 4, 0], self.totals.between(2, 2).tolist())
+        self.assertEquals([0, 0, 0], self.totals.between(3, 2).tolist())
+
+    def testTop(self):
+        totals = self.totals.between(1, 5)
+        self.assertEquals([(1, 8), (2, 7)], self.totals.top(totals, 2))
+        self.assertEquals([(2, 7), (3, 1)], self.totals.top(totals, 5, totals < 8))
+
+
+class PageCacheTests(TransactionTestCase):
+    def setUp(self):
+        self.user = makeUser("test-pages")
+        a = Artist.objects.create(name='a')
+        b = Artist.objects.create(name='b')
+        for week in xrange(5):
+            WeekData.objects.create(user=self.user, week_idx=week, artist=a, plays=week + 1, rank=1)
+            WeekData.objects.create(user=self.user, week_idx=week, artist=b, plays=1, rank=2)
+        User.objects.record_saved_weeks(self.user.id, range(5), range(5))
+        usercache.bump_version(self.user.id)
+        self.url = reverse(views.user_chart, args=[self.user.username, 0, 4])
+
+    def testNotModifiedByETag(self):
+        first = self.client.get(self.url)
+        self.assertEqual(200, first.status_code)
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(304, again.status_code)
+        self.assertEqual(first['ETag'], again['ETag'])
+
+    def testNotModifiedSince(self):
+        first = self.client.get(self.url)
+        again = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(304, again.status_code)
+
+    def testRenderedAgainAfterDataChanges(self):
+        first = self.client.get(self.url)
+        usercache.bump_version(self.user.id)
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(200, again.status_code)
+        self.assertNotEqual(first['ETag'], again['ETag'])
+
+    def testParametersChangeKey(self):
+        one = self.client.get(self.url, {'count': 1})
+        two = self.client.get(self.url, {'count': 2})
+        self.assertEqual((200, 200), (one.status_code, two.status_code))
+        self.assertNotEqual(one['ETag'], two['ETag'])
+        self.assertEqual(304, self.client.get(self.url, {'count': 1}, HTTP_IF_NONE_MATCH=one['ETag']).status_code)
+        self.assertEqual(200, self.client.get(self.url, {'count': 2}, HTTP_IF_NONE_MATCH=one['ETag']).status_code)
+
+    def testNotCachedFromOldSnapshot(self):
+        root = tempfile.mkdtemp()
+        url = reverse(views.user_chart, args=[self.user.username, 0, 5])
+        xml = ('<lfm status="ok"><weeklyartistchart><artist rank="1"><name>Latecomer</name>'
+               '<playcount>50</playcount></artist></weeklyartistchart></lfm>')
+        parse_and_save = getattr(tasks, '__parse_and_save')
+        update = snapshot.update
+        during = []
+        def render_then_update(user_id, week_idxs):
+            # Week 5 is saved but the snapshot doesn't have it yet.
+            during.append(self.client.get(url))
+            return update(user_id, week_idxs)
+        try:
+            with override_settings(LASTFM_SNAPSHOT_DIR=root):
+                snapshot.build(self.user.id)
+                self.client.get(url)
+                snapshot.update = render_then_update
+                # The chart for week 5, ending Sunday noon on 2005-03-27.
+                complete, _ = parse_and_save(self.user.id, self.user.username,
+                        [(1111320002, 1111924802, lambda: xml)], Update.ARTIST)
+                self.assertEqual(set([5]), complete)
+                self.assertNotIn('Latecomer', during[0].content)
+                self.assertIn('Latecomer', self.client.get(url).content)
+        finally:
+            snapshot.update = update
+            shutil.rmtree(root)
+
+
 class WeekDataTests(TransactionTestCase):
     def setUp(self):
         self.user = makeUser("test-charts")
@@ -189,9 +574,143 @@ class WeekDataTests(TransactionTestCase):
                 if plays is not None:
                     WeekData.objects.create(user=self.user, week_idx=week, artist=artist, plays=plays, rank=1)
                 week += 1
+        # Nothing cached for an earlier user with the same id applies.
+        usercache.bump_version(self.user.id)
+
+    def testWeekTotals(self):
+        UserWeekTotal.objects.rebuild(self.user.id)
+        self.assertEquals([(0, 1), (1, 4), (2, 3), (3, 5), (4, 6)],
+                          list(WeekData.objects.weekly_play_counts(self.user, 0, 4)))
+        self.assertEquals(19, WeekData.objects.total_plays_between(self.user, 0, 4))
+        self.assertEquals([1, 3, 4], sorted(idx for idx, _, _ in
+                          WeekData.objects.record_unique_artists_in_week(self.user, 0, 4, num=3)))
+
+    def testWeeklyPlayCountsVersioned(self):
+        UserWeekTotal.objects.rebuild(self.user.id)
+        before = list(WeekData.objects.weekly_play_counts(self.user, 0, 60))
+        self.assertEquals((4, 6), before[-1])
+        UserWeekTotal.objects.create(user=self.user, week_idx=60, total_plays=3, unique_artists=1)
+        self.assertEquals(before, list(WeekData.objects.weekly_play_counts(self.user, 0, 60)))
+
+        usercache.bump_version(self.user.id)
+        after = list(WeekData.objects.weekly_play_counts(self.user, 0, 60))
+        self.assertEquals(61, len(after))
+        self.assertEquals([(59, 0), (60, 3)], after[-2:])
+        self.assertEquals([(4, 6)], list(WeekData.objects.weekly_play_counts(self.user, 4, 4)))
+
+    def testOverviewSummary(self):
+        UserWeekTotal.objects.rebuild(self.user.id)
+        overview = summary.OverviewSummary(self.user, 0, 4)
+        self.assertEquals(19, overview.total_plays)
+        self.assertEquals(list(WeekData.objects.weekly_play_counts(self.user, 0, 4)), overview.wpcs)
+        self.assertEquals(WeekData.objects.monthly_counts_js(self.user, 0, 4), overview.mcjs)
+        self.assertEquals(WeekData.objects.weekly_play_counts_histogram(self.user, 0, 4),
+                          (overview.wpc_hist, overview.wpc_hist_step))
+        self.assertEquals([(4, 6), (3, 5), (1, 4)], [(idx, plays) for idx, _, plays in overview.record_total_plays[:3]])
+        self.assertEquals([(self.a, 15), (self.b, 4)], [(a, c) for a, c in overview.chart])
+        self.assertEquals(15, overview.chart.max)
+        self.assertEquals((4, 5), (overview.record_single_artist[0][0].week_idx,
+                                   overview.record_single_artist[0][0].plays))
+        self.assertEquals(2, overview.queries)
+
+    def testOverviewSummaryRetriedAfterError(self):
+        UserWeekTotal.objects.rebuild(self.user.id)
+        overview = summary.OverviewSummary(self.user, 0, 4)
+        def failing_fetch():
+            raise ValueError("database went away")
+        overview._fetch = failing_fetch
+        self.assertRaises(ValueError, getattr, overview, 'total_plays')
+        self.assertRaises(ValueError, getattr, overview, 'chart')
+        del overview._fetch
+        self.assertEquals(19, overview.total_plays)
+
+    def testOverviewSummaryUsesCachedTotals(self):
+        UserWeekTotal.objects.rebuild(self.user.id)
+        wpcs = list(WeekData.objects.weekly_play_counts(self.user, 0, 4))
+        # The blocks cached by weekly_play_counts answer the summary too.
+        UserWeekTotal.objects.filter(user=self.user).delete()
+        overview = summary.OverviewSummary(self.user, 0, 4)
+        self.assertEquals(wpcs, overview.wpcs)
+        self.assertEquals([(1, 2), (3, 2), (4, 2)],
+                          sorted((idx, n) for idx, _, n in overview.record_unique_artists[:3]))
+
+    def testSnapshot(self):
+        root = tempfile.mkdtemp()
+        try:
+            with override_settings(LASTFM_SNAPSHOT_DIR=root):
+                self.assertEquals(None, snapshot.load(self.user.id))
+                self.assertEquals(8, snapshot.build(self.user.id))
+                snap = snapshot.load(self.user.id)
+                self.assertEquals([1, 1, 2, 3, 3], snap.between(1, 3).week_idx.tolist())
+
+                # A new week and a changed one.
+                WeekData.objects.create(user=self.user, week_idx=6, artist=self.b, plays=9, rank=1)
+                WeekData.objects.filter(user=self.user, week_idx=0).update(plays=7)
+                self.assertEquals(9, snapshot.update(self.user.id, [0, 6]))
+                playsOfB = WeekData.objects.user_weekly_plays_of_artists(self.user.id, self.b.id, 0, 10)
+                self.assertEquals([(1, 2), (3, 1), (4, 1), (6, 9)], playsOfB)
+
+                snapChart = list(chart.Chart(self.user, 0, 6))
+            self.assertEquals(list(chart.Chart(self.user, 0, 6)), snapChart)
+        finally:
+            shutil.rmtree(root)
+
+    def testSnapshotWaitsForLastChunk(self):
+        root = tempfile.mkdtemp()
+        try:
+            with override_settings(LASTFM_SNAPSHOT_DIR=root):
+                snapshot.build(self.user.id)
+                # Week 6 is still being fetched when week 5 is saved.
+                WeekData.objects.create(user=self.user, week_idx=5, artist=self.a, plays=2, rank=1)
+                update = Update.objects.create(user=self.user, week_idx=6, type=Update.ARTIST)
+                tasks._snapshot_saved(self.user.id, set([5]))
+                self.assertEquals(None, snapshot.load(self.user.id))
+
+                WeekData.objects.create(user=self.user, week_idx=6, artist=self.b, plays=9, rank=1)
+                Update.objects.finish(self.user.id, Update.ARTIST, set([6]), set())
+                tasks._snapshot_saved(self.user.id, set([6]))
+                self.assertEquals([5, 6], snapshot.load(self.user.id).between(5, 6).week_idx.tolist())
+                self.assertEquals(Update.COMPLETE, Update.objects.get(id=update.id).status)
+        finally:
+            shutil.rmtree(root)
 
     def testUserWeeklyPlaysOfArtist(self):
         playsOfA = WeekData.objects.user_weekly_plays_of_artists(self.user.id, self.a.id, 0, 10)
         playsOfB = WeekData.objects.user_weekly_plays_of_artists(self.user.id, self.b.id, 0, 2)
         self.assertEquals([(0, 1), (1, 2), (2, 3), (3, 4), (4, 5)], playsOfA)
         self.assertEquals([(1, 2)], playsOfB)
+
+    def testPackedStorage(self):
+        objects = WeekData.objects
+        rows = objects.week_rows(self.user.id)
+        full = list(chart.Chart(self.user, 0, 4))
+        new = chart.Chart(self.user, 3, 4)
+        new.set_exclude_before_start()
+        new = list(new)
+        records = [(w.week_idx, w.artist_id, w.plays) for w, _ in objects.record_weeks(self.user, 0, 4, 3)]
+        UserWeekTotal.objects.rebuild(self.user.id)
+        totals = list(UserWeekTotal.objects.filter(user=self.user).order_by('week_idx')
+                          .values_list('week_idx', 'total_plays', 'unique_artists'))
+
+        self.assertEquals(8, PackedWeekData.objects.pack(self.user.id))
+        WeekData.objects.filter(user=self.user).delete()
+        with override_settings(WEEK_DATA_STORAGE='packed'):
+            self.assertEquals(sorted(rows), sorted(objects.week_rows(self.user.id)))
+            self.assertEquals(19, objects.total_plays(self.user))
+            self.assertEquals(0, objects.first_available_week(self.user))
+            self.assertEquals(full, list(chart.Chart(self.user, 0, 4)))
+            packedNew = chart.Chart(self.user, 3, 4)
+            packedNew.set_exclude_before_start()
+            self.assertEquals(new, list(packedNew))
+            self.assertEquals(records, [(w.week_idx, w.artist_id, w.plays)
+                                        for w, _ in objects.record_weeks(self.user, 0, 4, 3)])
+            self.assertEquals([(1, 2), (3, 1)],
+                              objects.user_weekly_plays_of_artists(self.user.id, self.b.id, 0, 3))
+            UserWeekTotal.objects.rebuild(self.user.id)
+            self.assertEquals(totals, list(UserWeekTotal.objects.filter(user=self.user).order_by('week_idx')
+                                               .values_list('week_idx', 'total_plays', 'unique_artists')))
+
+            # New weeks are written packed too.
+            self.assertEquals(1, objects.insert_weeks(self.user.id, {5: {self.b.id: (7, 1)}}))
+            self.assertEquals([(5, self.b.id, 7, 1)], objects.week_rows(self.user.id, 5, 5))
+        self.assertEquals(0, WeekData.objects.filter(user=self.user).count())
@@ -13,7 +13,7 @@ __user_base     = '^user/' + USER_REGEX + '/'
 # match week indexes
 __date_matcher  = r'(?P<start>\d+)-(?P<end>\d+)/$'
 __year_matcher  = r'(?P<year>\d{4})/$'
-__default_dates = { 'start': ldates.idx_beginning, 'end': ldates.idx_last_sunday }
+__default_dates = { 'start': ldates.idx_beginning, 'end': ldates.LAST_SUNDAY }
 
 urlpatterns = patterns('lastfmexplorer.views',
     # start
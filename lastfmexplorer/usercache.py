@@ -0,0 +1,116 @@
+"""
+Caching of per-user results that goes stale as soon as the user's data changes.
+
+Every user has a data version in the cache, and every key made by key() has
+it inside, so bump_version() retires all of a user's cached results at once.
+Results over ranges of weeks are cached in blocks of a year each (see
+blocks_between) so that any range of weeks can be put together from the same
+few entries.
+
+Hits and misses are counted in the cache too, per kind of result, and shown
+on /status/cache/.
+"""
+import time
+
+from django.core.cache import cache
+
+import ldates
+
+BLOCK_WEEKS = ldates.year_in_weeks
+
+# Versions and counters outlive any single result, up to memcached's limit.
+LONG_TIMEOUT = 60 * 60 * 24 * 30
+
+_STATS_KEY = "usercache:%s:%s"
+_STATS_KINDS = "usercache:kinds"
+
+
+def _version_key(user_id):
+    return "%d:data_version" % (user_id,)
+
+def data_version(user_id):
+    """
+    Returns the user's data version, starting one if there isn't one.  New
+    versions start from the clock so that a version lost from the cache is
+    never handed out again.
+    """
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time()), LONG_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+def bump_version(user_id):
+    """Marks everything cached for the user as out of date."""
+    try:
+        return cache.incr(_version_key(user_id))
+    except ValueError:
+        return data_version(user_id)
+
+def key(user_id, *parts):
+    """A cache key for parts of the user's data at its current version."""
+    return ":".join(map(str, (user_id, data_version(user_id)) + parts))
+
+
+def _count(kind, outcome, n):
+    if n:
+        key = _STATS_KEY % (kind, outcome)
+        try:
+            cache.incr(key, n)
+        except ValueError:
+            if not cache.add(key, n, LONG_TIMEOUT):
+                cache.incr(key, n)
+            kinds = cache.get(_STATS_KINDS) or []
+            if kind not in kinds:
+                cache.set(_STATS_KINDS, sorted(kinds + [kind]), LONG_TIMEOUT)
+
+def stats():
+    """
+    Returns [(kind, hits, misses, hit rate as a percentage)] for every kind
+    of result cached so far.
+    """
+    kinds = cache.get(_STATS_KINDS) or []
+    counts = cache.get_many([_STATS_KEY % (k, o) for k in kinds for o in ('hits', 'misses')])
+    result = []
+    for kind in kinds:
+        hits = counts.get(_STATS_KEY % (kind, 'hits'), 0)
+        misses = counts.get(_STATS_KEY % (kind, 'misses'), 0)
+        result.append((kind, hits, misses, 100 * hits / max(hits + misses, 1)))
+    return result
+
+
+def blocks_between(start, end):
+    return range(start / BLOCK_WEEKS, end / BLOCK_WEEKS + 1)
+
+def block_weeks(block):
+    """The first and last week index in a block."""
+    return block * BLOCK_WEEKS, (block + 1) * BLOCK_WEEKS - 1
+
+def cached_blocks(user_id, kind, start, end, fetch):
+    """
+    Returns the cached blocks covering weeks start to end as a list of lists,
+    one per block in order.  Missing blocks are filled with fetch(first,
+    last), which returns the rows for weeks first to last as (week_idx, ...)
+    tuples ordered by week, and cached.
+    """
+    blocks = blocks_between(start, end)
+    prefix = key(user_id, kind)
+    keys = dict(("%s:%d" % (prefix, block), block) for block in blocks)
+    found = dict((keys[k], rows) for k, rows in cache.get_many(keys.keys()).iteritems())
+    missing = [block for block in blocks if block not in found]
+    _count(kind, 'hits', len(found))
+    _count(kind, 'misses', len(missing))
+
+    if missing:
+        # One query for the span of every missing block, split up afterwards.
+        first, last = block_weeks(missing[0])[0], block_weeks(missing[-1])[1]
+        fetched = dict((block, []) for block in missing)
+        for row in fetch(first, last):
+            block = row[0] / BLOCK_WEEKS
+            if block in fetched:
+                fetched[block].append(row)
+        found.update(fetched)
+        cache.set_many(dict(("%s:%d" % (prefix, block), rows) for block, rows in fetched.iteritems()))
+
+    return [found[block] for block in blocks]
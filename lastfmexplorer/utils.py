@@ -1,6 +1,9 @@
 """
 Helpful bitsandpieces.
 """
+import threading
+
+from collections import OrderedDict
 
 def nicetime(seconds):
     """
@@ -50,3 +53,134 @@ def google_chart_url(self, data, dates):
             ("&".join("%s=%s" % kv for kv in args.iteritems()),)
 
 
+
+
+
+class LRUCache(object):
+    """
+    A bounded, thread safe mapping that forgets its least recently used
+    entries.  Counts hits and misses so its usefulness can be checked.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get_many(self, keys):
+        """Returns a dictionary of the given keys found in the cache."""
+        found = {}
+        with self.__lock:
+            for key in keys:
+                try:
+                    # Reinsert to mark as most recently used.
+                    value = self.__entries.pop(key)
+                    self.__entries[key] = value
+                    found[key] = value
+                    self.hits += 1
+                except KeyError:
+                    self.misses += 1
+        return found
+
+    def set_many(self, mapping):
+        with self.__lock:
+            for key, value in mapping.iteritems():
+                self.__entries.pop(key, None)
+                self.__entries[key] = value
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.__lock:
+            for key in keys:
+                self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        """Returns a dictionary of size, hits, misses and hit rate."""
+        lookups = self.hits + self.misses
+        return { 'size' : len(self.__entries),
+                 'hits' : self.hits,
+                 'misses' : self.misses,
+                 'hit_rate' : float(self.hits) / lookups if lookups else 0.0 }
+
+
+class WeekSet(object):
+    """
+    A set of week indexes held as the bits of a single number, so a user's
+    whole history is a couple of hundred bytes and ranges can be checked with
+    a mask.
+    """
+
+    def __init__(self, bits=0):
+        self.bits = long(bits)
+
+    @classmethod
+    def of(cls, week_idxs):
+        weeks = cls()
+        weeks.update(week_idxs)
+        return weeks
+
+    def update(self, week_idxs):
+        for idx in week_idxs:
+            self.bits |= 1L << idx
+
+    def discard(self, week_idxs):
+        for idx in week_idxs:
+            self.bits &= ~(1L << idx)
+
+    def first(self):
+        """The lowest week in the set, or None if it's empty."""
+        return (self.bits & -self.bits).bit_length() - 1 if self.bits else None
+
+    def last(self):
+        """The highest week in the set, or None if it's empty."""
+        return self.bits.bit_length() - 1 if self.bits else None
+
+    def any_between(self, start, end):
+        """True if any week from start to end inclusive is in the set."""
+        start = max(start, 0)
+        if end < start:
+            return False
+        return bool((self.bits >> start) & ((1L << (end - start + 1)) - 1))
+
+    def missing_between(self, start, end):
+        """A WeekSet of the weeks from start to end inclusive not in this one."""
+        start = max(start, 0)
+        if end < start:
+            return WeekSet()
+        return WeekSet(~self.bits & (((1L << (end - start + 1)) - 1) << start))
+
+    def __contains__(self, idx):
+        return idx >= 0 and bool((self.bits >> idx) & 1)
+
+    def __iter__(self):
+        bits, idx = self.bits, 0
+        while bits:
+            if bits & 1:
+                yield idx
+            bits >>= 1
+            idx += 1
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __nonzero__(self):
+        return bool(self.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, WeekSet) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<WeekSet:%d weeks>" % (len(self),)
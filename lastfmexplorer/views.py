@@ -1,8 +1,13 @@
+import hashlib
 import logging
 import json
+import time
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
 from django.http import Http404
+from django.utils.http import http_date, parse_http_date_safe
 from django.shortcuts import render_to_response, redirect
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
@@ -11,10 +16,14 @@ from django.template import RequestContext
 import tasks
 from models import *
 from chart import Chart
+from summary import OverviewSummary
 import requester
+import usercache
 
 
 _REQUESTER = requester.LastFMRequester()
+if getattr(settings, 'LASTFM_RESPONSE_CACHE', None):
+    _REQUESTER = requester.CachingRequester(_REQUESTER, settings.LASTFM_RESPONSE_CACHE)
 
 def start(request):
     feedback = {}
@@ -69,7 +78,7 @@ def __date_redirection(request, target):
     except Exception:
         # TODO: indicate errors, use better default dates (last available for user)
         if not end:
-            end = ldates.idx_last_sunday
+            end = ldates.index_of_last_sunday()
 
     if start > end:
         temp  = start
@@ -129,11 +138,33 @@ def poll_update_status(request):
 ###############################################################################
 # Interesting bits and pieces.
 
-# TODO: Does use of ldates.idx_last_sunday only work in the week after the server is started..?
+def __page_key(view_name, user, start, end, GET):
+    """
+    The cache key of a rendered page.  It changes with the user's data
+    version, the week the site thinks it is and every parameter that can
+    change the page.
+    """
+    # original_start and original_end only matter to the date form redirect.
+    params = sorted((k, v) for k, v in GET.lists() if k not in ('original_start', 'original_end'))
+    digest = hashlib.sha1(repr((start, end, ldates.index_of_last_sunday(), params))).hexdigest()
+    return usercache.key(user.id, 'page', view_name, digest)
+
+def __not_modified(request, etag, rendered_at):
+    """
+    True if the client's copy of the page is current: it has the page's ETag,
+    or failing that the cached page hasn't been rendered since its
+    If-Modified-Since.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # GZipMiddleware marks the ETags of compressed responses.
+        tags = [t.strip().replace(';gzip"', '"') for t in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return bool(rendered_at and if_modified_since and int(rendered_at) <= if_modified_since)
 
 def staged(target_view, skip_date_shortcuts=False):
     def inner(fn):
-        #@cache_page(twothreefall.settings.CACHE_USER_TIMEOUT)
         def cleansed(request, username, year=None, start=None, end=None, monthsAgo=None, yearsAgo=None, **kwargs):
             """
             1. Does the user exist?
@@ -146,24 +177,27 @@ def staged(target_view, skip_date_shortcuts=False):
                 return redirect(update, username)
 
             # Never updated their data?
-            # TODO: Calculate date from user object, not a query. ldates.first_sunday_on_or_after(user.registered)
-            faw = WeekData.objects.first_available_week(user)
-            if not isinstance(faw, int):
+            faw = user.first_available_week
+            if faw is None:
                 raise Http404
 
+            last_sunday = ldates.index_of_last_sunday()
+            if end == ldates.LAST_SUNDAY:
+                end = last_sunday
+
             if year:
                 year = int(year)
                 start, end = ldates.indicies_of_year(year)
             elif monthsAgo:
                 start = max(0, ldates.months_ago(int(monthsAgo)))
-                end   = ldates.idx_last_sunday
+                end   = last_sunday
             elif yearsAgo:
                 start = max(0, ldates.years_ago(int(yearsAgo)))
-                end   = ldates.idx_last_sunday
+                end   = last_sunday
             else:
                 start = int(start) if (start and int(start) > faw) else faw
                 end   = min(int(end) if end else ldates.fsoob(user.last_updated), 
-                          ldates.idx_last_sunday)
+                          last_sunday)
 
             # Do this or just fail to 'no data in this range page?'
             if start > end: temp = end; end = start; start = temp
@@ -199,7 +233,7 @@ def staged(target_view, skip_date_shortcuts=False):
             # shortcuts for links to and presentation of dates.
             if not skip_date_shortcuts:
                 context['template']['year_shortcuts'] = ldates.years_to_today()
-                context['template']['years_ago'] = range(1, ldates.today.year - ldates.the_beginning.year + 1)
+                context['template']['years_ago'] = range(1, ldates.today().year - ldates.the_beginning.year + 1)
 
             if 'count' in G:
                 try:
@@ -208,16 +242,32 @@ def staged(target_view, skip_date_shortcuts=False):
                 except Exception:
                     pass
 
-            # Fail if there's definitely no data for this range.
-            if not WeekData.objects.user_weeks_between(user, start, end).exists():
-                return render_to_response('exploration/no-data-for-dates.html',
-                                          { 'context' : context },
-                                          context_instance=RequestContext(request))
-
-            result = fn(request, context)
-
-            return render_to_response(target_view, result,
-                    context_instance=RequestContext(request))
+            # Rendered pages are cached until the user's data changes.
+            page_key = __page_key(fn.__name__, user, start, end, G)
+            etag = '"%s"' % (hashlib.sha1(page_key).hexdigest(),)
+            cached = cache.get(page_key)
+            if __not_modified(request, etag, cached and cached[1]):
+                response = HttpResponseNotModified()
+            elif cached:
+                response = HttpResponse(cached[0])
+            else:
+                # Fail if there's definitely no data for this range.
+                if not user.weeks_with_data.any_between(start, end):
+                    return render_to_response('exploration/no-data-for-dates.html',
+                                              { 'context' : context },
+                                              context_instance=RequestContext(request))
+
+                result = fn(request, context)
+
+                response = render_to_response(target_view, result,
+                        context_instance=RequestContext(request))
+                cached = (response.content, time.time())
+                cache.set(page_key, cached, getattr(settings, 'CACHE_USER_TIMEOUT', None))
+
+            response['ETag'] = etag
+            if cached:
+                response['Last-Modified'] = http_date(cached[1])
+            return response
         
         cleansed.__name__ = fn.__name__
         cleansed.__dict__ = fn.__dict__
@@ -245,8 +295,10 @@ def overview(request, context):
         #        (num, ', '.join(to_s(item) for item in artists[:-1]),
         #         to_s(artists[-1]))
 
+    summary = OverviewSummary(user, start, end)
+
     # vital stats.  TODO: Rework.
-    total_plays = WeekData.objects.total_plays_between(user, start, end)
+    total_plays = summary.total_plays
     total_weeks = float(end - start) + 1
     vitals = [
             "<b>%d</b> weeks, <b>%d</b> days" % (total_weeks, total_weeks * 7),
@@ -259,18 +311,18 @@ def overview(request, context):
         ]
 
     # weekly playcounts image and monthly playcounts bar chart
-    wpcs = WeekData.objects.weekly_play_counts(user, start, end)
-    mcjs  = WeekData.objects.monthly_counts_js(user, start, end)
+    wpcs = summary.wpcs
+    mcjs  = summary.mcjs
 
     # record weeks and overall chart
-    record_single_artist  = WeekData.objects.record_weeks(user, start, end)
-    record_total_plays    = WeekData.objects.record_week_totals(user, start, end)
-    record_unique_artists = WeekData.objects.record_unique_artists_in_week(user, start, end)
+    record_single_artist  = summary.record_single_artist
+    record_total_plays    = summary.record_total_plays
+    record_unique_artists = summary.record_unique_artists
 
-    chart = Chart(user, start, end)
+    chart = summary.chart
 
     # weekly playcounts histogram
-    wpc_hist, wpc_hist_step = WeekData.objects.weekly_play_counts_histogram(user, start, end)
+    wpc_hist, wpc_hist_step = summary.wpc_hist, summary.wpc_hist_step
     return { 'context' : context,
              'wpc_hist' : wpc_hist,
              'wpc_hist_step' : wpc_hist_step,
@@ -344,9 +396,8 @@ def user_data(request, context):
      (2010, ...)
     """
     user  = context.get('user')
-    scrobbledin = set(map(lambda x: x['week_idx'],
-                          WeekData.objects.filter(user=user.id).values('week_idx').distinct()))
-    errors = set(map(lambda w: w.week_idx, WeeksWithSyntaxErrors.objects.filter(user=user.id)))
+    scrobbledin = user.weeks_with_data
+    errors = set(WeeksWithSyntaxErrors.objects.filter(user=user.id).values_list('week_idx', flat=True))
 
     years = list(ldates.years_to_today())
     years.reverse()
@@ -380,6 +431,6 @@ def status(request):
 
 def weekly_plays_of_artist(request, user_id, artist_id):
     start = request.GET.get("start", ldates.idx_beginning)
-    end = request.GET.get("end", ldates.idx_last_sunday)
+    end = request.GET.get("end", ldates.index_of_last_sunday())
     plays = WeekData.objects.user_weekly_plays_of_artists(user_id, artist_id, start, end)
     return HttpResponse(json.dumps(plays), mimetype="application/json")
\ No newline at end of file
@@ -4,6 +4,8 @@ from django.conf import settings
 
 import datetime
 
+from lastfmexplorer import usercache
+
 ###############################################################################
 # Memcached status
 
@@ -45,6 +47,7 @@ def memcached_status(request):
             'memcached_status.html', dict(
                 stats=stats,
                 hit_rate=100 * stats.get_hits / max(stats.cmd_get, 1),
+                user_data=usercache.stats(),
                 time=datetime.datetime.now(), # server time
             ))
     else: